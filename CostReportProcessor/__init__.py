@@ -6,6 +6,7 @@ import typing
 
 import azure.functions as func
 from ..TaskExecutor.helper import *
+from ..TaskExecutor.ingestion import upload_logs
 
 def main(blob: func.InputStream):
     '''
@@ -80,8 +81,4 @@ def upload_cost_data(rows, time_generated, monitor_client):
         for row in rows
     ]
 
-    monitor_client.upload(
-        rule_id=os.environ['AzureMonitorDataCollectionRuleIdCostData'],
-        stream_name=os.environ['AzureMonitorDataCollectionStreamNameCostData'],
-        logs=data
-    )
+    upload_logs(monitor_client, 'CostData', data)
@@ -1,10 +1,16 @@
+import datetime
 import json
 import logging
 import os
 import typing
+import uuid
 
 import azure.functions as func
 from .helper import *
+from .ingestion import after_spooled_writes, tracked_unit
+from .manifest import RunTaskOutput, UploadProgress, get_run_manifest, task_unit
+from .scheduler import get_task_scheduler
+from .telemetry import set_status, span, task_telemetry
 from .list_visible_subscriptions import list_visible_subscriptions
 from .list_cosmos_database_accounts import list_cosmos_database_accounts
 from .get_cosmos_database_account_services import get_cosmos_database_account_services
@@ -50,22 +56,96 @@ def main(msgin: func.QueueMessage, msgout: func.Out[typing.List[str]]):
     if metrics_client is None:
         metrics_client = get_metrics_client(mgmt_credential)
 
-    if task == 'ListVisibleSubscriptions':
-        list_visible_subscriptions(subscription_client, msgout)
-    elif task == 'ListCosmosDatabaseAccounts':
-        list_cosmos_database_accounts(task_data['subscriptionName'], cosmos_clients[subscription_id], msgout)
-    elif task == 'GetCosmosDatabaseAccountServices':
-        get_cosmos_database_account_services(subscription_id, task_data['subscriptionName'], resource_group, account_name, deserialize_cosmos_object(task_data['accountData']), cosmos_clients[subscription_id], monitor_client, msgout)
-    elif task == 'ListCosmosDatabases':
-        list_cosmos_databases(resource_group, account_name, _input['rid'], task_data['APIKind'], cosmos_clients[subscription_id], msgout)
-    elif task == 'GetCosmosDatabaseThroughput':
-        get_cosmos_database_throughput(resource_group, account_name, database_name, deserialize_cosmos_object(task_data['databaseData']), task_data['APIKind'], cosmos_clients[subscription_id], monitor_client, msgout)
-    elif task == 'ListCosmosContainers':
-        list_cosmos_containers(resource_group, account_name, database_name, task_data['APIKind'], cosmos_clients[subscription_id], msgout)
-    elif task == 'GetCosmosContainerThroughput':
-        get_cosmos_container_throughput(resource_group, account_name, database_name, container_name, deserialize_cosmos_object(task_data['containerData']), task_data['APIKind'], cosmos_clients[subscription_id], monitor_client, msgout)
-    elif task == 'GetCosmosContainerMetrics':
-        account_rid = resource_id(subscription=subscription_id, resource_group=resource_group, namespace=rid['namespace'], type=rid['type'], name=account_name)
-        get_cosmos_container_metrics(task_data['metricType'], account_rid, account_name, database_name, container_name, task_data.get('isSharedThroughput'), metrics_client, monitor_client)
-    else:
-        raise ValueError('Received unexpected input.')
+    task_id = str(uuid.uuid4())
+    # Shard lease taken when the task scheduler forwarded this task, released once it has finished.
+    lease = _input.get('shardLease')
+    try:
+        with task_telemetry(_input, msgin, subscription_id, task_id, monitor_client):
+            # Skip units already completed in this run and replay the messages they emitted,
+            # so retries and restarts only redo unfinished work.
+            run_id = _input.get('runId')
+            unit = task_unit(task, _input.get('rid'), task_data)
+            manifest = get_run_manifest() if run_id is not None else None
+            if manifest is not None:
+                with span('Manifest'):
+                    outputs = manifest.get(run_id, unit)
+                if outputs is not None:
+                    logging.info(f'Skipping {unit} already completed in run {run_id}.')
+                    set_status('Skipped')
+                    emit_tasks(outputs, msgout, lease)
+                    return
+            task_output = RunTaskOutput({'runId': run_id, 'correlationId': _input.get('correlationId'), 'parentTaskId': task_id})
+
+            with tracked_unit(UploadProgress(manifest, run_id, unit) if manifest is not None else None) as spooled_tables:
+                if task == 'ListVisibleSubscriptions':
+                    list_visible_subscriptions(subscription_client, task_output)
+                elif task == 'ListCosmosDatabaseAccounts':
+                    list_cosmos_database_accounts(task_data['subscriptionName'], cosmos_clients[subscription_id], task_output)
+                elif task == 'GetCosmosDatabaseAccountServices':
+                    get_cosmos_database_account_services(subscription_id, task_data['subscriptionName'], resource_group, account_name, deserialize_cosmos_object(task_data['accountData']), cosmos_clients[subscription_id], monitor_client, task_output)
+                elif task == 'ListCosmosDatabases':
+                    list_cosmos_databases(resource_group, account_name, _input['rid'], task_data['APIKind'], cosmos_clients[subscription_id], task_output)
+                elif task == 'GetCosmosDatabaseThroughput':
+                    get_cosmos_database_throughput(resource_group, account_name, database_name, deserialize_cosmos_object(task_data['databaseData']), task_data['APIKind'], cosmos_clients[subscription_id], monitor_client, task_output)
+                elif task == 'ListCosmosContainers':
+                    list_cosmos_containers(resource_group, account_name, database_name, _input['rid'], task_data.get('databaseThroughputMode'), task_data['APIKind'], cosmos_clients[subscription_id], task_output)
+                elif task == 'GetCosmosContainerThroughput':
+                    get_cosmos_container_throughput(resource_group, account_name, database_name, container_name, deserialize_cosmos_object(task_data['containerData']), task_data['APIKind'], task_data.get('cachedBy'), cosmos_clients[subscription_id], monitor_client, task_output)
+                elif task == 'GetCosmosContainerMetrics':
+                    account_rid = resource_id(subscription=subscription_id, resource_group=resource_group, namespace=rid['namespace'], type=rid['type'], name=account_name)
+                    get_cosmos_container_metrics(task_data['metricType'], account_rid, account_name, database_name, container_name, task_data.get('isSharedThroughput'), metrics_client, monitor_client)
+                else:
+                    raise ValueError('Received unexpected input.')
+
+            if manifest is not None:
+                # Rows still held in the spool would be lost with this worker, so only
+                # record the unit once they have been uploaded.
+                outputs = task_output.get()
+                with span('Manifest'):
+                    after_spooled_writes(spooled_tables, lambda: manifest.complete(run_id, unit, outputs))
+            emit_tasks(task_output.get(), msgout, lease)
+    except Exception:
+        release_shard_lease(lease)
+        raise
+
+def emit_tasks(messages, msgout, lease=None):
+    '''
+        Sends follow-up task messages to the sharded queues if the task scheduler
+        is enabled, otherwise directly to the tasks queue. Messages are stamped
+        with the time they are enqueued, to measure dequeue lag across queues.
+    '''
+    messages = stamp_enqueued_at(messages)
+    task_scheduler = get_task_scheduler()
+    if task_scheduler is None:
+        if messages:
+            msgout.set(messages)
+        return
+    with span('Scheduler'):
+        schedule_tasks(task_scheduler, messages, lease)
+
+def schedule_tasks(task_scheduler, messages, lease):
+    shards = task_scheduler.enqueue(messages)
+    if lease:
+        task_scheduler.release(lease)
+        shards.add(lease['shard'])
+    # Top up the tasks queue from the shards this task freed a lease in or added work to,
+    # instead of waiting for the next TaskScheduler run, which drains all shards.
+    # Follow-up messages are already enqueued, so a failure here must not fail the task.
+    try:
+        task_scheduler.drain(shards)
+    except Exception as e:
+        logging.warning(f'Draining shards {sorted(shards)} failed, leaving them to TaskScheduler: {e}')
+
+def stamp_enqueued_at(messages):
+    enqueued_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    stamped = []
+    for message in messages:
+        message = json.loads(message)
+        message['enqueuedAt'] = enqueued_at
+        stamped.append(json.dumps(message))
+    return stamped
+
+def release_shard_lease(lease):
+    task_scheduler = get_task_scheduler()
+    if task_scheduler is not None and lease:
+        task_scheduler.release(lease)
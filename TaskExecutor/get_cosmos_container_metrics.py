@@ -5,6 +5,20 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .ingestion import spool_logs, upload_logs
+from .telemetry import span
+
+# Mirrors operation type classification used by dashboards/overview.kql.
+OPERATION_CHARGE_CLASSES = {
+    'Query': 'QueryCharge',
+    'Read': 'ReadCharge',
+    'ReadFeed': 'ReadCharge',
+    'Create': 'WriteCharge',
+    'Replace': 'WriteCharge',
+    'Patch': 'WriteCharge',
+    'Excecute': 'StoredProcCharge'
+}
+IDLE_HOUR_REQUEST_THRESHOLD = 10
 
 def get_cosmos_container_metrics(metric_type, account_rid, account_name, database_name, container_name, is_shared_throughput, metrics_client, monitor_client):
     '''
@@ -24,25 +38,125 @@ def get_cosmos_container_metrics(metric_type, account_rid, account_name, databas
         raise ValueError('Received unexpected input.')
 
     time_generated = generate_iso8601_timestamp()
-    data = [
-        {
+    with span('Flatten'):
+        data = [
+            {
+                'TimeGenerated': time_generated,
+                'DatabaseAccountName': account_name,
+                'DatabaseName': database_name,
+                'ContainerName': container_name,
+                'MetricTimestamp': metric[0],
+                'MetricName': metric[1],
+                'MetricValue': metric[2],
+                'MetricMetadata': metric[3]
+            }
+            for metric in metrics
+        ]
+
+    upload_logs(monitor_client, 'ContainersMetrics', data)
+
+    # Daily summary is optional so that existing deployments without the summary table keep working.
+    if os.environ.get('AzureMonitorDataCollectionRuleIdContainersMetricsSummary'):
+        summary = {
             'TimeGenerated': time_generated,
             'DatabaseAccountName': account_name,
             'DatabaseName': database_name,
             'ContainerName': container_name,
-            'MetricTimestamp': metric[0],
-            'MetricName': metric[1],
-            'MetricValue': metric[2],
-            'MetricMetadata': metric[3]
+            'SummaryDate': (today_utc()-datetime.timedelta(days=1)).isoformat(),
+            'MetricType': metric_type
         }
-        for metric in metrics
-    ]
+        with span('Flatten'):
+            summary.update(summarize_cosmos_container_metrics(metric_type, metrics))
 
-    monitor_client.upload(
-        rule_id=os.environ['AzureMonitorDataCollectionRuleIdContainersMetrics'],
-        stream_name=os.environ['AzureMonitorDataCollectionStreamNameContainersMetrics'],
-        logs=data
-    )
+        spool_logs(monitor_client, 'ContainersMetricsSummary', [summary])
+
+def summarize_cosmos_container_metrics(metric_type, metrics):
+    '''
+        Collapses one day of raw metrics into a single summary row. Each metric_type
+        fills only the columns it has data for; the dashboard combines the rows
+        of all metric types with sum/max per container.
+    '''
+
+    if metric_type == 'Requests':
+        return summarize_cosmos_container_metrics_requests(metrics)
+    elif metric_type == 'ThroughputStorage':
+        return summarize_cosmos_container_metrics_throughput_storage(metrics)
+    elif metric_type == 'PartitionKeyUsage':
+        return summarize_cosmos_container_metrics_pkusage(metrics)
+    else:
+        raise ValueError('Received unexpected input.')
+
+def summarize_cosmos_container_metrics_requests(metrics):
+
+    charges = {charge_class: 0.0 for charge_class in ('QueryCharge', 'ReadCharge', 'WriteCharge', 'StoredProcCharge', 'OtherCharge')}
+    total_requests = 0.0
+    sample_hours = set()
+    active_hours = set()
+    # Requests and request units per region, and per region and hour to find idle hours
+    regions = {}
+    hourly_requests = {}
+
+    for timestamp, metric_name, metric_value, metadata in metrics:
+        metric_value = metric_value or 0
+        hour = timestamp[:13]
+        region = metadata['Region']
+        region_totals = regions.setdefault(region, {'TotalRequests': 0.0, 'TotalRequestUnits': 0.0})
+        active_hours.add(hour)
+        if metric_name == 'TotalRequests':
+            sample_hours.add(hour)
+            total_requests += metric_value
+            region_totals['TotalRequests'] += metric_value
+            hourly_requests[(region, hour)] = hourly_requests.get((region, hour), 0) + metric_value
+        elif metric_name == 'TotalRequestUnits':
+            charges[OPERATION_CHARGE_CLASSES.get(metadata['OperationType'], 'OtherCharge')] += metric_value
+            region_totals['TotalRequestUnits'] += metric_value
+
+    for region, region_totals in regions.items():
+        region_totals['IdleHours'] = sum(1 for hour in active_hours if hourly_requests.get((region, hour), 0) < IDLE_HOUR_REQUEST_THRESHOLD)
+
+    summary = {
+        'SampleHours': len(sample_hours),
+        'ActiveHours': len(active_hours),
+        'TotalRequests': total_requests,
+        'RequestsByRegion': regions
+    }
+    summary.update(charges)
+    return summary
+
+def summarize_cosmos_container_metrics_throughput_storage(metrics):
+
+    peaks = {}
+    for timestamp, metric_name, metric_value, metadata in metrics:
+        if metric_value is not None:
+            peaks[metric_name] = max(peaks.get(metric_name, metric_value), metric_value)
+
+    return {
+        'DataUsed': peaks.get('DataUsage'),
+        'IndexUsed': peaks.get('IndexUsage'),
+        'DocumentCount': peaks.get('DocumentCount')
+    }
+
+def summarize_cosmos_container_metrics_pkusage(metrics):
+
+    max_normalized_ru = None
+    # Average normalized RU consumption per region and partition key range, used to detect partition skew
+    partition_samples = {}
+    for timestamp, metric_name, metric_value, metadata in metrics:
+        if metric_value is None:
+            continue
+        max_normalized_ru = metric_value if max_normalized_ru is None else max(max_normalized_ru, metric_value)
+        samples = partition_samples.setdefault(metadata['Region'], {}).setdefault(metadata['PartitionKeyRangeId'], [0.0, 0])
+        samples[0] += metric_value
+        samples[1] += 1
+
+    return {
+        'MaxNormalizedRU': max_normalized_ru,
+        'PhysicalPartitions': len({partition for region in partition_samples.values() for partition in region}),
+        'PartitionThroughputByRegion': {
+            region: {partition: round(total/count, 3) for partition, (total, count) in partitions.items()}
+            for region, partitions in partition_samples.items()
+        }
+    }
 
 def get_cosmos_container_metrics_requests(account_rid, database_name, container_name, metrics_client):
 
@@ -63,15 +177,16 @@ def get_cosmos_container_metrics_requests(account_rid, database_name, container_
 
     metrics_results = []
     
-    for metric in container_metrics.metrics:
-        for time_series_element in metric.timeseries:
-            for metric_value in time_series_element.data:
-                metadata = {
-                    'OperationType': time_series_element.metadata_values['operationtype'],
-                    'Region': time_series_element.metadata_values['region'],
-                    'StatusCode': int(time_series_element.metadata_values['statuscode'])
-                }
-                metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.count, metadata))
+    with span('Flatten'):
+        for metric in container_metrics.metrics:
+            for time_series_element in metric.timeseries:
+                for metric_value in time_series_element.data:
+                    metadata = {
+                        'OperationType': time_series_element.metadata_values['operationtype'],
+                        'Region': time_series_element.metadata_values['region'],
+                        'StatusCode': int(time_series_element.metadata_values['statuscode'])
+                    }
+                    metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.count, metadata))
 
     return metrics_results
 
@@ -95,13 +210,14 @@ def get_cosmos_container_metrics_throughput_storage(account_rid, database_name,
             filter=f"DatabaseName eq '{database_name}' and CollectionName eq '{container_name}'"
         )
         
-        for metric in container_metrics.metrics:
-            for time_series_element in metric.timeseries:
-                for metric_value in time_series_element.data:
-                    if metric.name == 'ProvisionedThroughput' or metric.name == 'AutoscaleMaxThroughput':
-                        metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.maximum, None))
-                    else:
-                        metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.total, None))
+        with span('Flatten'):
+            for metric in container_metrics.metrics:
+                for time_series_element in metric.timeseries:
+                    for metric_value in time_series_element.data:
+                        if metric.name == 'ProvisionedThroughput' or metric.name == 'AutoscaleMaxThroughput':
+                            metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.maximum, None))
+                        else:
+                            metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.total, None))
     else:
         container_metrics = metrics_client.query_resource(
             resource_uri=account_rid,
@@ -115,10 +231,11 @@ def get_cosmos_container_metrics_throughput_storage(account_rid, database_name,
             filter=f"DatabaseName eq '{database_name}' and CollectionName eq '__Empty'"
         )
 
-        for metric in container_metrics.metrics:
-            for time_series_element in metric.timeseries:
-                for metric_value in time_series_element.data:
-                    metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.maximum, None))
+        with span('Flatten'):
+            for metric in container_metrics.metrics:
+                for time_series_element in metric.timeseries:
+                    for metric_value in time_series_element.data:
+                        metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.maximum, None))
 
         container_metrics = metrics_client.query_resource(
             resource_uri=account_rid,
@@ -132,10 +249,11 @@ def get_cosmos_container_metrics_throughput_storage(account_rid, database_name,
             filter=f"DatabaseName eq '{database_name}' and CollectionName eq '{container_name}'"
         )
 
-        for metric in container_metrics.metrics:
-            for time_series_element in metric.timeseries:
-                for metric_value in time_series_element.data:
-                    metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.total, None))
+        with span('Flatten'):
+            for metric in container_metrics.metrics:
+                for time_series_element in metric.timeseries:
+                    for metric_value in time_series_element.data:
+                        metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.total, None))
 
         container_metrics = metrics_client.query_resource(
             resource_uri=account_rid,
@@ -148,10 +266,11 @@ def get_cosmos_container_metrics_throughput_storage(account_rid, database_name,
             filter=f"DatabaseName eq '{database_name}'"
         )
 
-        for metric in container_metrics.metrics:
-            for time_series_element in metric.timeseries:
-                for metric_value in time_series_element.data:
-                    metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.total, None))
+        with span('Flatten'):
+            for metric in container_metrics.metrics:
+                for time_series_element in metric.timeseries:
+                    for metric_value in time_series_element.data:
+                        metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.total, None))
 
     return metrics_results
 
@@ -171,14 +290,15 @@ def get_cosmos_container_metrics_pkusage(account_rid, database_name, container_n
 
     metrics_results = []
 
-    for metric in container_metrics.metrics:
-        for time_series_element in metric.timeseries:
-            for metric_value in time_series_element.data:
-                metadata = {
-                    'Region': time_series_element.metadata_values['region'],
-                    'PartitionKeyRangeId': time_series_element.metadata_values['partitionkeyrangeid'],
-                    'PhysicalPartitionId': time_series_element.metadata_values['physicalpartitionid']
-                }
-                metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.maximum, metadata))
+    with span('Flatten'):
+        for metric in container_metrics.metrics:
+            for time_series_element in metric.timeseries:
+                for metric_value in time_series_element.data:
+                    metadata = {
+                        'Region': time_series_element.metadata_values['region'],
+                        'PartitionKeyRangeId': time_series_element.metadata_values['partitionkeyrangeid'],
+                        'PhysicalPartitionId': time_series_element.metadata_values['physicalpartitionid']
+                    }
+                    metrics_results.append((metric_value.timestamp.replace(tzinfo=datetime.timezone.utc).isoformat(), metric.name, metric_value.maximum, metadata))
 
     return metrics_results
@@ -4,8 +4,11 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .ingestion import spool_logs
+from .telemetry import annotate, span
+from .topology_cache import invalidate
 
-def get_cosmos_container_throughput(resource_group, account_name, database_name, container_name, cosmos_container, api_kind, cosmos_client, monitor_client, msgout):
+def get_cosmos_container_throughput(resource_group, account_name, database_name, container_name, cosmos_container, api_kind, cached_by, cosmos_client, monitor_client, msgout):
     '''
         Get container provisioned throughput, if available.
     '''
@@ -33,6 +36,13 @@ def get_cosmos_container_throughput(resource_group, account_name, database_name,
             container_throughput_value = container_throughput.resource.throughput
 
     except ResourceNotFoundError as e:
+        if cached_by is not None:
+            # Only containers of databases without shared throughput are served from the
+            # topology cache, so this one has been deleted since it was listed.
+            logging.info(f'{cosmos_container.id} no longer exists, dropping cached listing of {cached_by}.')
+            annotate('topologyCache', 'Deleted')
+            invalidate(cached_by)
+            return
         # container uses shared throughput
         container_throughput_mode = 'Shared'
         container_throughput_type = None
@@ -48,26 +58,23 @@ def get_cosmos_container_throughput(resource_group, account_name, database_name,
             raise ValueError('Received unexpected input.')
 
     time_generated = generate_iso8601_timestamp()
-    data = [
-        {
-            'TimeGenerated': time_generated,
-            'DatabaseAccountName': account_name,
-            'DatabaseName': database_name,
-            'ContainerName': container_name,
-            'ContainerThroughputMode': container_throughput_mode, 
-            'ContainerThroughputType': container_throughput_type, 
-            'ContainerThroughput': container_throughput_value,
-            'ContainerIndexingIsDefault': indexing_isdefault(cosmos_container, api_kind),
-            'ContainerTTL': container_ttl(cosmos_container, api_kind),
-            'AdditionalData': cosmos_container.as_dict()
-        }
-    ]
+    with span('Flatten'):
+        data = [
+            {
+                'TimeGenerated': time_generated,
+                'DatabaseAccountName': account_name,
+                'DatabaseName': database_name,
+                'ContainerName': container_name,
+                'ContainerThroughputMode': container_throughput_mode, 
+                'ContainerThroughputType': container_throughput_type, 
+                'ContainerThroughput': container_throughput_value,
+                'ContainerIndexingIsDefault': indexing_isdefault(cosmos_container, api_kind),
+                'ContainerTTL': container_ttl(cosmos_container, api_kind),
+                'AdditionalData': cosmos_container.as_dict()
+            }
+        ]
 
-    monitor_client.upload(
-        rule_id=os.environ['AzureMonitorDataCollectionRuleIdContainersConfig'],
-        stream_name=os.environ['AzureMonitorDataCollectionStreamNameContainersConfig'],
-        logs=data
-    )
+    spool_logs(monitor_client, 'ContainersConfig', data)
 
     msg = []
     msg.append(json.dumps({'task': 'GetCosmosContainerMetrics', 'rid': cosmos_container.id, 'taskData': {'metricType': 'Requests', 'APIKind': api_kind}}))
@@ -5,6 +5,8 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .ingestion import spool_logs
+from .telemetry import span
 
 def get_cosmos_database_account_services(subscription_id, subscription_name, resource_group, account_name, cosmos_account, cosmos_client, monitor_client, msgout):
     '''
@@ -14,24 +16,21 @@ def get_cosmos_database_account_services(subscription_id, subscription_name, res
     cosmos_account_services = next(cosmos_client.service.list(resource_group, account_name), None)
     
     time_generated = generate_iso8601_timestamp()
-    data = [
-        {
-            'TimeGenerated': time_generated,
-            'SubscriptionId': subscription_id,
-            'SubscriptionName': subscription_name,
-            'ResourceGroup': resource_group,
-            'DatabaseAccountName': account_name,
-            'APIKind': get_api_kind(cosmos_account),
-            'CapacityMode': get_capacity_mode(cosmos_account),
-            'AdditionalData': include_service_data(cosmos_account, cosmos_account_services)
-        }
-    ]
+    with span('Flatten'):
+        data = [
+            {
+                'TimeGenerated': time_generated,
+                'SubscriptionId': subscription_id,
+                'SubscriptionName': subscription_name,
+                'ResourceGroup': resource_group,
+                'DatabaseAccountName': account_name,
+                'APIKind': get_api_kind(cosmos_account),
+                'CapacityMode': get_capacity_mode(cosmos_account),
+                'AdditionalData': include_service_data(cosmos_account, cosmos_account_services)
+            }
+        ]
     
-    monitor_client.upload(
-        rule_id=os.environ['AzureMonitorDataCollectionRuleIdDatabaseAccountsConfig'],
-        stream_name=os.environ['AzureMonitorDataCollectionStreamNameDatabaseAccountsConfig'],
-        logs=data
-    )
+    spool_logs(monitor_client, 'DatabaseAccountsConfig', data)
 
     msgout.set(
         [
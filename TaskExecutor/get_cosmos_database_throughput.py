@@ -4,6 +4,8 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .ingestion import spool_logs
+from .telemetry import span
 
 def get_cosmos_database_throughput(resource_group, account_name, database_name, cosmos_database, api_kind, cosmos_client, monitor_client, msgout):
     '''
@@ -50,23 +52,20 @@ def get_cosmos_database_throughput(resource_group, account_name, database_name,
             raise ValueError('Received unexpected input.')
 
     time_generated = generate_iso8601_timestamp()
-    data = [
-        {
-            'TimeGenerated': time_generated,
-            'DatabaseAccountName': account_name,
-            'DatabaseName': database_name,
-            'DatabaseThroughputMode': database_throughput_mode, 
-            'DatabaseThroughputType': database_throughput_type, 
-            'DatabaseThroughput': database_throughput_value,
-            'AdditionalData': cosmos_database.as_dict()
-        }
-    ]
+    with span('Flatten'):
+        data = [
+            {
+                'TimeGenerated': time_generated,
+                'DatabaseAccountName': account_name,
+                'DatabaseName': database_name,
+                'DatabaseThroughputMode': database_throughput_mode, 
+                'DatabaseThroughputType': database_throughput_type, 
+                'DatabaseThroughput': database_throughput_value,
+                'AdditionalData': cosmos_database.as_dict()
+            }
+        ]
 
-    monitor_client.upload(
-        rule_id=os.environ['AzureMonitorDataCollectionRuleIdDatabasesConfig'],
-        stream_name=os.environ['AzureMonitorDataCollectionStreamNameDatabasesConfig'],
-        logs=data
-    )
+    spool_logs(monitor_client, 'DatabasesConfig', data)
 
     msgout.set(
         [
@@ -75,7 +74,8 @@ def get_cosmos_database_throughput(resource_group, account_name, database_name,
                     'task': 'ListCosmosContainers', 
                     'rid': cosmos_database.id, 
                     'taskData': {
-                        'APIKind': api_kind
+                        'APIKind': api_kind,
+                        'databaseThroughputMode': database_throughput_mode
                     }
                 }
             ) 
@@ -13,6 +13,8 @@ from azure.mgmt.subscription import SubscriptionClient
 from azure.monitor.ingestion import LogsIngestionClient
 from azure.monitor.query import MetricAggregationType, MetricsQueryClient
 
+from .telemetry import client_hooks
+
 
 def get_azure_credential(scope, logging_enable=False, logger=None):
     '''
@@ -28,15 +30,16 @@ def get_azure_subscription_client(credential, logging_enable=False, logger=None)
         Acquires a new client for interacting with Azure Subscriptions.
         Client is not specific to one subscription. 
     '''
-    return SubscriptionClient(credential, logging_enable=logging_enable, logger=logger)
+    return SubscriptionClient(credential, logging_enable=logging_enable, logger=logger, **client_hooks())
 
 def get_cosmos_mgmt_client(subscription_id, credential, logging_enable=False, logger=None):
     '''
         Acquires Cosmos DB Management client. Client is specific to Azure subscription.
         If HTTP logging is enabled, patch logger to emit remaining API quota 
-        that is otherwise redacted.
+        that is otherwise redacted. If telemetry is enabled, remaining quota 
+        is also recorded in watcher telemetry.
     '''
-    cosmos_client = CosmosDBManagementClient(credential, subscription_id, logging_enable=logging_enable, logger=logger)
+    cosmos_client = CosmosDBManagementClient(credential, subscription_id, logging_enable=logging_enable, logger=logger, **client_hooks())
     cosmos_client._client._config.http_logging_policy.allowed_header_names.add('x-ms-ratelimit-remaining-subscription-reads')
     return cosmos_client
 
@@ -46,7 +49,7 @@ def get_metrics_client(credential, logging_enable=False, logger=None):
         If HTTP logging is enabled, patch logger to emit remaining API quota 
         that is otherwise redacted.
     '''
-    metrics_client = MetricsQueryClient(credential, logging_enable=logging_enable, logger=logger)
+    metrics_client = MetricsQueryClient(credential, logging_enable=logging_enable, logger=logger, **client_hooks())
     metrics_client._client._config.http_logging_policy.allowed_header_names.add('x-ms-ratelimit-remaining-subscription-reads')
     return metrics_client
 
@@ -0,0 +1,430 @@
+import atexit
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+
+from . import telemetry
+
+# Azure Monitor Logs Ingestion API accepts at most 1MB per request. The SDK gzips each
+# chunk it sends and splits on the same uncompressed size, so keeping our chunks
+# under this budget maps every chunk to exactly one HTTP request.
+MAX_CHUNK_BYTES = 1000000
+# Rows a spool keeps for retry while Azure Monitor is unavailable, per table.
+MAX_BUFFERED_BYTES = 50 * MAX_CHUNK_BYTES
+MAX_CONCURRENCY = 4
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 2
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Identifies write-ahead files of this worker process. PIDs alone are reused by
+# restarted workers, particularly in containers.
+PROCESS_ID = uuid.uuid4().hex
+
+log_spool = None
+# Unit of work running on this thread, see tracked_unit.
+current = threading.local()
+
+
+def get_stream_config(table):
+    '''
+        Returns Data Collection Rule id and stream name configured for a table,
+        e.g. table 'ContainersMetrics' reads AzureMonitorDataCollectionRuleIdContainersMetrics
+        and AzureMonitorDataCollectionStreamNameContainersMetrics.
+    '''
+    return (
+        os.environ[f'AzureMonitorDataCollectionRuleId{table}'],
+        os.environ[f'AzureMonitorDataCollectionStreamName{table}']
+    )
+
+def chunk_logs(logs, max_chunk_bytes=MAX_CHUNK_BYTES):
+    '''
+        Streams records into chunks whose serialized size stays within max_chunk_bytes.
+        A single record larger than the budget is emitted as a chunk on its own.
+        Yields (chunk, chunk_bytes) tuples.
+    '''
+    chunk = []
+    chunk_bytes = 0
+    for log in logs:
+        log_bytes = len(json.dumps(log).encode('utf-8'))
+        if chunk and chunk_bytes + log_bytes > max_chunk_bytes:
+            yield chunk, chunk_bytes
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(log)
+        chunk_bytes += log_bytes
+    if chunk:
+        yield chunk, chunk_bytes
+
+def is_transient(error):
+    '''
+        Authentication, schema and Data Collection Rule errors fail the same way on
+        every attempt and are not retried.
+    '''
+    if isinstance(error, HttpResponseError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(error, ServiceRequestError)
+
+def upload_chunk(monitor_client, rule_id, stream_name, chunk, max_attempts=MAX_ATTEMPTS):
+    '''
+        Uploads one chunk, retrying with exponential backoff on transient failures.
+        The client's own retry policy already covers transient HTTP errors; this
+        additionally retries a chunk once those retries are exhausted, without
+        resending chunks that already succeeded.
+    '''
+    for attempt in range(1, max_attempts + 1):
+        try:
+            monitor_client.upload(rule_id=rule_id, stream_name=stream_name, logs=chunk)
+            return
+        except (HttpResponseError, ServiceRequestError) as e:
+            if attempt == max_attempts or not is_transient(e):
+                raise
+            logging.warning(f'Upload of {len(chunk)} rows to {stream_name} failed (attempt {attempt}/{max_attempts}): {e}')
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+def upload_logs(monitor_client, table, logs, max_chunk_bytes=MAX_CHUNK_BYTES, max_concurrency=MAX_CONCURRENCY, resumable=True):
+    '''
+        Shared uploader used by all tasks. Splits records into size-bounded chunks,
+        uploads chunks concurrently with per-chunk retry, and logs rows, bytes,
+        chunks, and latency for the target stream. Raises the first chunk error
+        after all chunks have been attempted.
+
+        If the unit of work running on this thread tracks upload progress, chunks
+        uploaded by an earlier attempt of the unit are skipped. Records must then
+        be in the same order on every attempt.
+    '''
+    progress = getattr(current, 'progress', None) if resumable else None
+    with telemetry.span('Upload'):
+        rule_id, stream_name = get_stream_config(table)
+        start = time.perf_counter()
+        stats = {'stream': stream_name, 'rows': 0, 'bytes': 0, 'chunks': 0, 'skipped_chunks': 0}
+
+        chunks = []
+        for index, (chunk, chunk_bytes) in enumerate(chunk_logs(logs, max_chunk_bytes)):
+            if progress is not None and progress.is_uploaded(table, index):
+                stats['skipped_chunks'] += 1
+                continue
+            stats['rows'] += len(chunk)
+            stats['bytes'] += chunk_bytes
+            chunks.append((index, chunk))
+        stats['chunks'] = len(chunks)
+
+        def upload(index, chunk):
+            upload_chunk(monitor_client, rule_id, stream_name, chunk)
+            if progress is not None:
+                progress.uploaded(table, index)
+
+        if len(chunks) <= 1 or max_concurrency <= 1:
+            for index, chunk in chunks:
+                upload(index, chunk)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+                futures = [executor.submit(upload, index, chunk) for index, chunk in chunks]
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                raise errors[0]
+
+    stats['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    telemetry.count('IngestedRows', stats['rows'])
+    telemetry.count('IngestedBytes', stats['bytes'])
+    skipped = f", skipped {stats['skipped_chunks']} chunks uploaded earlier" if stats['skipped_chunks'] else ''
+    logging.info(f"Uploaded {stats['rows']} rows ({stats['bytes']} bytes, {stats['chunks']} chunks) to {stream_name} in {stats['latency_ms']} ms{skipped}")
+    return stats
+
+def new_buffer():
+    return {'logs': [], 'bytes': 0, 'created': time.monotonic(), 'segments': [], 'callbacks': []}
+
+
+class LogSpool:
+    '''
+        Per-worker buffer that coalesces small uploads across invocations running
+        in the same host process. Records are buffered per table and flushed
+        through upload_logs once a table reaches max_rows, max_bytes, or its oldest
+        record is older than max_age_seconds, and on process shutdown.
+
+        If wal_directory is set, every buffered record is also appended to a local
+        write-ahead file so that rows buffered by a worker that crashed are
+        uploaded by the next worker that starts on the same host. Delivery is
+        at-least-once: a crash during a flush may upload the same rows twice.
+
+        Rows that fail to upload with a transient error are kept for the next
+        flush, up to max_buffered_bytes per table. Rows that fail otherwise, or
+        do not fit, are dropped and their write-ahead segments kept as .failed
+        files for inspection.
+    '''
+
+    def __init__(self, monitor_client, max_rows=10000, max_bytes=MAX_CHUNK_BYTES, max_age_seconds=60, wal_directory=None, max_buffered_bytes=MAX_BUFFERED_BYTES):
+        self.monitor_client = monitor_client
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_age_seconds = max_age_seconds
+        self.wal_directory = wal_directory
+        self.lock = threading.RLock()
+        self.buffers = {}
+        # Buffers taken by flushes that are still uploading, per table.
+        self.in_flight = {}
+        self.timers = {}
+        self.flush_sequence = 0
+        if wal_directory:
+            os.makedirs(wal_directory, exist_ok=True)
+            self.recover()
+
+    def add(self, table, logs):
+        '''
+            Buffers records for a table and flushes the table if any threshold is reached.
+        '''
+        with self.lock:
+            buffer = self.buffers.setdefault(table, new_buffer())
+            lines = [json.dumps(log) for log in logs]
+            if self.wal_directory and lines:
+                with open(self.wal_path(table), 'a', encoding='utf-8') as wal:
+                    wal.write(''.join(line + '\n' for line in lines))
+                    wal.flush()
+            if not buffer['logs']:
+                buffer['created'] = time.monotonic()
+                self.schedule(table)
+            buffer['logs'].extend(logs)
+            buffer['bytes'] += sum(len(line.encode('utf-8')) for line in lines)
+            is_full = (
+                len(buffer['logs']) >= self.max_rows or
+                buffer['bytes'] >= self.max_bytes or
+                time.monotonic() - buffer['created'] >= self.max_age_seconds
+            )
+
+        if is_full:
+            self.flush(table)
+
+    def flush(self, table):
+        '''
+            Uploads all records buffered for a table. On a transient failure records
+            are put back into the buffer, otherwise they are dropped. Either way the
+            error is logged, so a failed flush never fails the invocation that
+            happened to trigger it.
+        '''
+        with self.lock:
+            buffer = self.buffers.get(table)
+            if buffer is None or not buffer['logs']:
+                return
+            logs, segments = buffer['logs'], buffer['segments']
+            self.in_flight.setdefault(table, []).append(buffer)
+            if self.wal_directory and os.path.exists(self.wal_path(table)):
+                self.flush_sequence += 1
+                segment = f'{self.wal_path(table)}.{self.flush_sequence}.flushing'
+                os.replace(self.wal_path(table), segment)
+                segments = segments + [segment]
+            self.buffers[table] = new_buffer()
+            timer = self.timers.pop(table, None)
+            if timer is not None:
+                timer.cancel()
+
+        try:
+            upload_logs(self.monitor_client, table, logs, resumable=False)
+        except Exception as e:
+            logs_bytes = sum(len(json.dumps(log).encode('utf-8')) for log in logs)
+            with self.lock:
+                callbacks = self.landed(table, buffer)
+                buffer = self.buffers[table]
+                keep = is_transient(e) and buffer['bytes'] + logs_bytes <= self.max_buffered_bytes
+                if keep:
+                    if not buffer['logs']:
+                        self.schedule(table)
+                    buffer['logs'][:0] = logs
+                    buffer['bytes'] += logs_bytes
+                    buffer['segments'][:0] = segments
+                    buffer['callbacks'][:0] = callbacks
+            if keep:
+                logging.error(f'Flushing {len(logs)} spooled rows for {table} failed, keeping them buffered: {e}')
+            else:
+                # Callbacks are not called, so units whose rows were dropped are not recorded as complete.
+                logging.error(f'Flushing {len(logs)} spooled rows for {table} failed, dropping them: {e}')
+                for segment in segments:
+                    os.replace(segment, failed_path(segment))
+            return
+
+        with self.lock:
+            callbacks = self.landed(table, buffer)
+        for segment in segments:
+            os.remove(segment)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f'Callback after flushing {table} failed: {e}')
+
+    def landed(self, table, buffer):
+        '''
+            Removes a buffer from the flushes in flight and returns its callbacks,
+            including those attached while it was uploading.
+        '''
+        self.in_flight[table].remove(buffer)
+        return buffer['callbacks']
+
+    def after_flush(self, tables, callback):
+        '''
+            Calls callback once all records currently buffered for the given tables
+            have been uploaded, or right away if none are buffered. Records taken
+            by flushes still in flight on other threads count as buffered.
+        '''
+        with self.lock:
+            pending = [buffer for table in tables for buffer in self.in_flight.get(table, [])]
+            pending += [self.buffers[table] for table in tables if table in self.buffers and self.buffers[table]['logs']]
+            remaining = [len(pending)]
+
+            def on_flushed():
+                with self.lock:
+                    remaining[0] -= 1
+                    done = remaining[0] == 0
+                if done:
+                    callback()
+
+            for buffer in pending:
+                buffer['callbacks'].append(on_flushed)
+        if not pending:
+            callback()
+
+    def flush_all(self):
+        for table in list(self.buffers):
+            self.flush(table)
+
+    def schedule(self, table):
+        '''
+            Makes sure a table is flushed once its oldest record reaches max_age_seconds,
+            even if no further invocation lands on this worker.
+        '''
+        timer = threading.Timer(self.max_age_seconds, self.flush, args=(table,))
+        timer.daemon = True
+        self.timers[table] = timer
+        timer.start()
+
+    def wal_path(self, table):
+        return os.path.join(self.wal_directory, f'{table}.{os.getpid()}.{PROCESS_ID}.wal')
+
+    def recover(self):
+        '''
+            Adopts write-ahead files left behind by worker processes that are no longer
+            running and uploads their records. Each file is claimed by renaming it into
+            this process' namespace before it is read, so that workers starting
+            concurrently on the same host never adopt the same file.
+        '''
+        for file_name in sorted(os.listdir(self.wal_directory)):
+            parts = file_name.split('.')
+            if len(parts) < 4 or not parts[1].isdigit() or parts[3] != 'wal' or not owner_is_dead(int(parts[1]), parts[2]):
+                continue
+            table = parts[0]
+            path = os.path.join(self.wal_directory, file_name)
+            with self.lock:
+                self.flush_sequence += 1
+                claimed = f'{self.wal_path(table)}.{self.flush_sequence}.recovered'
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                # Claimed by another worker.
+                continue
+            path = claimed
+            with open(path, encoding='utf-8') as wal:
+                # Last line may be partially written if the worker crashed mid-append.
+                logs = []
+                for line in wal:
+                    try:
+                        logs.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logging.warning(f'Skipping corrupt record in {path}')
+            with self.lock:
+                buffer = self.buffers.setdefault(table, new_buffer())
+                buffer['logs'].extend(logs)
+                buffer['segments'].append(path)
+            logging.info(f'Recovered {len(logs)} spooled rows for {table} from {path}')
+            self.flush(table)
+
+
+def failed_path(segment):
+    '''
+        Renames {table}.{pid}.{process}.wal.* segments to {table}.{pid}.{process}.failed.*,
+        which recover() does not pick up.
+    '''
+    directory, file_name = os.path.split(segment)
+    parts = file_name.split('.')
+    parts[3] = 'failed'
+    return os.path.join(directory, '.'.join(parts))
+
+def owner_is_dead(pid, process_id):
+    '''
+        A write-ahead file belongs to a dead worker if its process is gone, or if
+        this process reused the PID of the worker that wrote it.
+    '''
+    if process_id == PROCESS_ID:
+        return False
+    return pid == os.getpid() or not process_is_alive(pid)
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def get_log_spool(monitor_client):
+    '''
+        Returns the spool of this worker process, creating it on first use, or None
+        if spooling is disabled. Configured through AzureMonitorSpool* app settings.
+    '''
+    global log_spool
+    if log_spool is None and os.environ.get('AzureMonitorSpoolEnabled', 'false').lower() == 'true':
+        log_spool = LogSpool(
+            monitor_client,
+            max_rows=int(os.environ.get('AzureMonitorSpoolMaxRows', 10000)),
+            max_bytes=int(os.environ.get('AzureMonitorSpoolMaxBytes', MAX_CHUNK_BYTES)),
+            max_age_seconds=float(os.environ.get('AzureMonitorSpoolMaxAgeSeconds', 60)),
+            wal_directory=os.environ.get('AzureMonitorSpoolDirectory') or None,
+            max_buffered_bytes=int(os.environ.get('AzureMonitorSpoolMaxBufferedBytes', MAX_BUFFERED_BYTES))
+        )
+        atexit.register(log_spool.flush_all)
+    return log_spool
+
+def spool_logs(monitor_client, table, logs):
+    '''
+        Buffers small uploads in the worker spool when spooling is enabled,
+        otherwise uploads immediately.
+    '''
+    spool = get_log_spool(monitor_client)
+    if spool is None:
+        upload_logs(monitor_client, table, logs)
+    else:
+        spool.add(table, logs)
+        spooled_tables = getattr(current, 'spooled_tables', None)
+        if spooled_tables is not None:
+            spooled_tables.add(table)
+
+@contextlib.contextmanager
+def tracked_unit(progress):
+    '''
+        Tracks uploads of the unit of work running on this thread. Chunks are
+        recorded in progress, if given, so that a retried unit resumes its
+        uploads. Yields the set of tables the unit wrote to the spool.
+    '''
+    current.progress = progress
+    current.spooled_tables = set()
+    try:
+        yield current.spooled_tables
+    finally:
+        current.progress = None
+        current.spooled_tables = None
+
+def after_spooled_writes(tables, callback):
+    '''
+        Calls callback once rows spooled for the given tables have been uploaded,
+        or right away if nothing was spooled.
+    '''
+    if log_spool is None or not tables:
+        callback()
+    else:
+        log_spool.after_flush(tables, callback)
@@ -4,34 +4,45 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .telemetry import span
+from .topology_cache import list_children
 
-def list_cosmos_containers(resource_group, account_name, database_name, api_kind, cosmos_client, msgout):
+def list_cosmos_containers(resource_group, account_name, database_name, database_rid, database_throughput_mode, api_kind, cosmos_client, msgout):
     '''
         List available containers wtihin a specific Cosmos DB database.
+
+        Containers of databases without shared throughput are reused from the
+        topology cache. Their throughput request fails if they have been deleted
+        since, whereas containers using shared throughput have none to begin with.
     '''
     
-    if api_kind == 'NoSQL':
-        cosmos_containers = [cosmos_container for cosmos_container in cosmos_client.sql_resources.list_sql_containers(resource_group_name=resource_group, account_name=account_name, database_name=database_name)]
-    elif api_kind == 'Mongo':
-        cosmos_containers = [cosmos_container for cosmos_container in cosmos_client.mongo_db_resources.list_mongo_db_collections(resource_group_name=resource_group, account_name=account_name, database_name=database_name)]
-    elif api_kind == 'Cassandra':
-        cosmos_containers = [cosmos_container for cosmos_container in cosmos_client.cassandra_resources.list_cassandra_tables(resource_group_name=resource_group, account_name=account_name, keyspace_name=database_name)]
-    elif api_kind == 'Table':
-        cosmos_containers = [cosmos_container for cosmos_container in cosmos_client.table_resources.list_tables(resource_group_name=resource_group, account_name=account_name)]
-    elif api_kind == 'Gremlin':
-        cosmos_containers = [cosmos_container for cosmos_container in cosmos_client.gremlin_resources.list_gremlin_graphs(resource_group_name=resource_group, account_name=account_name, database_name=database_name)]
-    else:
-        raise ValueError('Received unexpected input.')
-
-    msg = []
-    for cosmos_container in cosmos_containers:
-        if not api_kind == 'Table':
-            rid = cosmos_container.id
+    def list_resources():
+        if api_kind == 'NoSQL':
+            return [cosmos_container for cosmos_container in cosmos_client.sql_resources.list_sql_containers(resource_group_name=resource_group, account_name=account_name, database_name=database_name)]
+        elif api_kind == 'Mongo':
+            return [cosmos_container for cosmos_container in cosmos_client.mongo_db_resources.list_mongo_db_collections(resource_group_name=resource_group, account_name=account_name, database_name=database_name)]
+        elif api_kind == 'Cassandra':
+            return [cosmos_container for cosmos_container in cosmos_client.cassandra_resources.list_cassandra_tables(resource_group_name=resource_group, account_name=account_name, keyspace_name=database_name)]
+        elif api_kind == 'Table':
+            return [cosmos_container for cosmos_container in cosmos_client.table_resources.list_tables(resource_group_name=resource_group, account_name=account_name)]
+        elif api_kind == 'Gremlin':
+            return [cosmos_container for cosmos_container in cosmos_client.gremlin_resources.list_gremlin_graphs(resource_group_name=resource_group, account_name=account_name, database_name=database_name)]
         else:
-            rid = parse_resource_id(cosmos_container.id)
-            rid.pop('child_type_1')
-            rid['child_type_2'] = 'colls'
-            rid['child_name_2'] = rid.pop('child_name_1')
-            rid = resource_id(**rid, child_type_1='dbs', child_name_1='TablesDB')
-        msg.append(json.dumps({'task': 'GetCosmosContainerThroughput', 'rid': rid, 'taskData': {'containerData': serialize_cosmos_object(cosmos_container), 'APIKind': api_kind}}))
+            raise ValueError('Received unexpected input.')
+
+    cosmos_containers, cached = list_children(database_rid, list_resources, leaf=True, reuse=database_throughput_mode != 'Shared')
+    cached_by = database_rid if cached else None
+
+    with span('Flatten'):
+        msg = []
+        for cosmos_container in cosmos_containers:
+            if not api_kind == 'Table':
+                rid = cosmos_container.id
+            else:
+                rid = parse_resource_id(cosmos_container.id)
+                rid.pop('child_type_1')
+                rid['child_type_2'] = 'colls'
+                rid['child_name_2'] = rid.pop('child_name_1')
+                rid = resource_id(**rid, child_type_1='dbs', child_name_1='TablesDB')
+            msg.append(json.dumps({'task': 'GetCosmosContainerThroughput', 'rid': rid, 'taskData': {'containerData': serialize_cosmos_object(cosmos_container), 'APIKind': api_kind, 'cachedBy': cached_by}}))
     msgout.set(msg)
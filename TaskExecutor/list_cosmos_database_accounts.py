@@ -4,6 +4,7 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .telemetry import span
 
 def list_cosmos_database_accounts(subscription_name, cosmos_client, msgout):
     '''
@@ -12,18 +13,19 @@ def list_cosmos_database_accounts(subscription_name, cosmos_client, msgout):
 
     cosmos_accounts = [cosmos_account for cosmos_account in cosmos_client.database_accounts.list()]
 
-    msgout.set(
-        [
-            json.dumps(
-                {
-                    'task': 'GetCosmosDatabaseAccountServices', 
-                    'rid': cosmos_account.id, 
-                    'taskData': {
-                        'accountData': serialize_cosmos_object(cosmos_account),
-                        'subscriptionName': subscription_name
+    with span('Flatten'):
+        msgout.set(
+            [
+                json.dumps(
+                    {
+                        'task': 'GetCosmosDatabaseAccountServices', 
+                        'rid': cosmos_account.id, 
+                        'taskData': {
+                            'accountData': serialize_cosmos_object(cosmos_account),
+                            'subscriptionName': subscription_name
+                        }
                     }
-                }
-            ) 
-            for cosmos_account in cosmos_accounts
-        ]
-    )
+                ) 
+                for cosmos_account in cosmos_accounts
+            ]
+        )
@@ -4,6 +4,7 @@ import os
 
 import azure.functions as func
 from .helper import *
+from .telemetry import span
 
 def list_visible_subscriptions(subscription_client, msgout):
     '''
@@ -12,17 +13,18 @@ def list_visible_subscriptions(subscription_client, msgout):
     '''
     subscriptions = [subscription for subscription in subscription_client.subscriptions.list()]
 
-    msgout.set(
-        [
-            json.dumps(
-                {
-                    'task': 'ListCosmosDatabaseAccounts',
-                    'rid': subscription.id, 
-                    'taskData': {
-                        'subscriptionName': subscription.display_name
-                    }
-                } 
-            )
-            for subscription in subscriptions
-        ]
-    )
\ No newline at end of file
+    with span('Flatten'):
+        msgout.set(
+            [
+                json.dumps(
+                    {
+                        'task': 'ListCosmosDatabaseAccounts',
+                        'rid': subscription.id, 
+                        'taskData': {
+                            'subscriptionName': subscription.display_name
+                        }
+                    } 
+                )
+                for subscription in subscriptions
+            ]
+        )
\ No newline at end of file
@@ -0,0 +1,89 @@
+import json
+
+from .store import get_store
+
+run_manifest = None
+
+
+class RunManifest:
+    '''
+        Completion manifest recording the output messages of every finished unit,
+        scoped by run.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, run_id, unit):
+        return self.store.get(unit, scope=run_id)
+
+    def complete(self, run_id, unit, outputs):
+        self.store.put(unit, outputs, scope=run_id)
+
+
+def task_unit(task, rid, task_data):
+    '''
+        Identifies a unit of work within a run, i.e. a task applied to a resource.
+    '''
+    unit = f"{task}|{rid or ''}"
+    if task_data and task_data.get('metricType'):
+        unit += f"|{task_data['metricType']}"
+    return unit
+
+def get_run_manifest():
+    '''
+        Returns the completion manifest of this worker process, creating it on
+        first use, or None if WatcherManifestType is not set.
+    '''
+    global run_manifest
+    if run_manifest is None:
+        store = get_store('WatcherManifest', 'manifest')
+        if store is not None:
+            run_manifest = RunManifest(store)
+    return run_manifest
+
+
+class UploadProgress:
+    '''
+        Records every uploaded chunk of a unit in the manifest, so that a retried
+        unit does not upload chunks that an earlier attempt already ingested.
+    '''
+
+    def __init__(self, manifest, run_id, unit):
+        self.manifest = manifest
+        self.run_id = run_id
+        self.unit = unit
+
+    def is_uploaded(self, table, index):
+        return self.manifest.get(self.run_id, self.chunk_unit(table, index)) is not None
+
+    def uploaded(self, table, index):
+        self.manifest.complete(self.run_id, self.chunk_unit(table, index), [])
+
+    def chunk_unit(self, table, index):
+        return f'{self.unit}|{table}|{index}'
+
+
+class RunTaskOutput:
+    '''
+        Stands in for the queue output binding while a task runs. Stamps every
+        outgoing message with run and correlation fields and holds messages back
+        until the task has finished, so they can be recorded in the manifest
+        before being sent.
+    '''
+
+    def __init__(self, fields):
+        self.fields = {name: value for name, value in fields.items() if value is not None}
+        self.messages = []
+
+    def set(self, messages):
+        self.messages = []
+        for message in messages:
+            if self.fields:
+                message = json.loads(message)
+                message.update(self.fields)
+                message = json.dumps(message)
+            self.messages.append(message)
+
+    def get(self):
+        return self.messages
@@ -0,0 +1,307 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import zlib
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from azure.mgmt.core.tools import parse_resource_id
+from azure.storage.queue import QueueClient, TextBase64DecodePolicy, TextBase64EncodePolicy
+
+# Lower value drains first. Discovery runs ahead of configuration, which runs ahead of metrics.
+TASK_PRIORITIES = {
+    'ListVisibleSubscriptions': 0,
+    'ListCosmosDatabaseAccounts': 0,
+    'ListCosmosDatabases': 0,
+    'ListCosmosContainers': 0,
+    'GetCosmosDatabaseAccountServices': 1,
+    'GetCosmosDatabaseThroughput': 1,
+    'GetCosmosContainerThroughput': 1,
+    'GetCosmosContainerMetrics': 2
+}
+PRIORITIES = sorted(set(TASK_PRIORITIES.values()))
+MAX_RECEIVE_BATCH = 32
+VISIBILITY_TIMEOUT_SECONDS = 60
+# A task holds its shard lease while it waits in the tasks queue and runs. Leases
+# of tasks that never finish, e.g. because their worker crashed, expire after this.
+LEASE_SECONDS = 600
+
+task_scheduler = None
+
+
+def create_queue(queue_client):
+    '''
+        Creates a queue. Returns False if it already existed.
+    '''
+    try:
+        queue_client.create_queue()
+        return True
+    except ResourceExistsError:
+        return False
+
+def shard_for(subscription_id, shard_count):
+    '''
+        Maps a subscription to a shard. Uses crc32 rather than hash() so that
+        all workers agree on the mapping.
+    '''
+    if not subscription_id:
+        return 0
+    return zlib.crc32(subscription_id.lower().encode('utf-8')) % shard_count
+
+
+class InMemoryQueue:
+    '''
+        Local stand-in for azure.storage.queue.QueueClient implementing the
+        subset of its interface used by TaskScheduler.
+    '''
+
+    QueueMessage = collections.namedtuple('QueueMessage', ['id', 'content', 'pop_receipt'])
+    QueueProperties = collections.namedtuple('QueueProperties', ['approximate_message_count'])
+
+    def __init__(self):
+        self.messages = collections.deque()
+        self.invisible = {}
+        self.ids = itertools.count()
+        self.pop_receipts = itertools.count()
+        self.created = False
+        self.calls = 0
+
+    def create_queue(self):
+        self.calls += 1
+        if self.created:
+            raise ResourceExistsError('The specified queue already exists.')
+        self.created = True
+
+    def send_message(self, content):
+        self.calls += 1
+        self.messages.append(self.QueueMessage(next(self.ids), content, None))
+
+    def receive_messages(self, max_messages=1, visibility_timeout=None):
+        self.calls += 1
+        received = []
+        while self.messages and len(received) < max_messages:
+            message = self.messages.popleft()._replace(pop_receipt=str(next(self.pop_receipts)))
+            self.invisible[message.id] = message
+            received.append(message)
+        return received
+
+    def peek_messages(self, max_messages=1):
+        self.calls += 1
+        return list(itertools.islice(self.messages, max_messages))
+
+    def delete_message(self, message, pop_receipt=None):
+        self.calls += 1
+        self.pop(message, pop_receipt)
+
+    def update_message(self, message, pop_receipt=None, visibility_timeout=None):
+        self.calls += 1
+        self.messages.appendleft(self.pop(message, pop_receipt)._replace(pop_receipt=None))
+
+    def pop(self, message, pop_receipt):
+        '''
+            Like Storage queues, accepts a message or its id and pop receipt, and
+            rejects pop receipts of messages that have since been received again.
+        '''
+        message_id = getattr(message, 'id', message)
+        pop_receipt = pop_receipt or getattr(message, 'pop_receipt', None)
+        invisible = self.invisible.get(message_id)
+        if invisible is None or invisible.pop_receipt != pop_receipt:
+            raise ResourceNotFoundError('The specified message does not exist.')
+        return self.invisible.pop(message_id)
+
+    def get_queue_properties(self):
+        self.calls += 1
+        return self.QueueProperties(len(self.messages) + len(self.invisible))
+
+
+class TaskScheduler:
+    '''
+        Shards task messages across queues by subscription and task priority, and
+        feeds them into the tasks queue consumed by TaskExecutor.
+
+        Each drain forwards at most enough messages to bring the tasks queue up to
+        target_depth. Shards take turns by smooth weighted round-robin, and within
+        a shard higher-priority queues are drained first.
+
+        At most shard_cap tasks of a shard are in flight, i.e. waiting in the tasks
+        queue or running, at any time. Every shard has a lease queue holding
+        shard_cap lease messages. Forwarding a task receives one of them, which
+        hides it for LEASE_SECONDS, and stamps it onto the task as shardLease.
+        TaskExecutor releases the lease once the task has finished. A subscription
+        with thousands of containers therefore cannot starve the others or exceed
+        its share of the crawl's read quota.
+    '''
+
+    def __init__(self, queue_factory, shard_count, shard_cap=16, shard_weights=None, target_depth=64, queue_prefix='tasks', lease_seconds=LEASE_SECONDS):
+        self.queue_factory = queue_factory
+        self.shard_count = shard_count
+        self.shard_cap = shard_cap
+        self.shard_weights = shard_weights or [1] * shard_count
+        self.target_depth = target_depth
+        self.queue_prefix = queue_prefix
+        self.lease_seconds = lease_seconds
+        self.queues = {}
+
+    def queue(self, name):
+        if name not in self.queues:
+            queue_client = self.queue_factory(name)
+            create_queue(queue_client)
+            self.queues[name] = queue_client
+        return self.queues[name]
+
+    def lease_queue(self, shard):
+        '''
+            Lease messages are only added by whichever worker creates the lease queue,
+            so concurrent workers never add more than shard_cap of them. Changing
+            WatcherShardCap requires deleting the lease queues.
+        '''
+        name = f'{self.queue_prefix}-{shard}-leases'
+        if name not in self.queues:
+            queue_client = self.queue_factory(name)
+            if create_queue(queue_client):
+                for _ in range(self.shard_cap):
+                    queue_client.send_message('lease')
+            self.queues[name] = queue_client
+        return self.queues[name]
+
+    def shard_queue_name(self, shard, priority):
+        return f'{self.queue_prefix}-{shard}-p{priority}'
+
+    def enqueue(self, messages):
+        '''
+            Routes task messages to the queue of their subscription's shard and task
+            priority. Returns the shards messages were sent to.
+        '''
+        shards = set()
+        for message in messages:
+            _input = json.loads(message)
+            subscription_id = parse_resource_id(_input['rid']).get('subscription') if _input.get('rid') else None
+            shard = shard_for(subscription_id, self.shard_count)
+            priority = TASK_PRIORITIES.get(_input['task'], PRIORITIES[-1])
+            self.queue(self.shard_queue_name(shard, priority)).send_message(message)
+            shards.add(shard)
+        return shards
+
+    def release(self, lease):
+        '''
+            Returns the shard lease of a finished task.
+        '''
+        if not lease:
+            return
+        try:
+            self.lease_queue(lease['shard']).update_message(lease['id'], pop_receipt=lease['popReceipt'], visibility_timeout=0)
+        except HttpResponseError:
+            # The lease expired and may already have been handed out again.
+            logging.warning(f"Shard {lease['shard']} lease {lease['id']} expired before its task finished.")
+
+    def drain(self, shards=None):
+        '''
+            Moves messages from shard queues into the tasks queue, considering only
+            the given shards if any. Returns the number of messages forwarded per shard.
+        '''
+        tasks_queue = self.queue(self.queue_prefix)
+        budget = self.target_depth - tasks_queue.get_queue_properties().approximate_message_count
+        forwarded = [0] * self.shard_count
+        buffers = [collections.deque() for _ in range(self.shard_count)]
+        current_weights = [0] * self.shard_count
+        candidates = {shard for shard in (range(self.shard_count) if shards is None else shards) if self.shard_weights[shard] > 0}
+        exhausted = set()
+
+        while budget > 0 and candidates:
+            total_weight = 0
+            for shard in candidates:
+                current_weights[shard] += self.shard_weights[shard]
+                total_weight += self.shard_weights[shard]
+            shard = max(candidates, key=lambda s: current_weights[s])
+            current_weights[shard] -= total_weight
+
+            if not buffers[shard] and shard not in exhausted:
+                if not self.receive(shard, buffers[shard], min(MAX_RECEIVE_BATCH, budget)):
+                    exhausted.add(shard)
+            if not buffers[shard]:
+                candidates.discard(shard)
+                continue
+
+            source_queue, message, lease = buffers[shard].popleft()
+            content = json.loads(message.content)
+            content['shardLease'] = {'shard': shard, 'id': lease.id, 'popReceipt': lease.pop_receipt}
+            tasks_queue.send_message(json.dumps(content))
+            source_queue.delete_message(message)
+            forwarded[shard] += 1
+            budget -= 1
+
+        # Received but not forwarded messages and their leases are made visible again right away.
+        for shard, buffer in enumerate(buffers):
+            for source_queue, message, lease in buffer:
+                source_queue.update_message(message, visibility_timeout=0)
+                self.lease_queue(shard).update_message(lease, visibility_timeout=0)
+
+        if any(forwarded):
+            logging.info(f'Forwarded {sum(forwarded)} tasks, per shard: {forwarded}')
+        return forwarded
+
+    def receive(self, shard, buffer, max_messages):
+        '''
+            Receives up to max_messages of the shard's highest-priority waiting tasks,
+            each with a lease. Waiting tasks are peeked first and only as many leases
+            taken as there are tasks, so an idle shard costs one peek per priority
+            and a shard at its cap one more call. Leases left over, e.g. if another
+            worker received the peeked tasks first, are released right away.
+            Returns False if the shard ran out of leases or waiting tasks.
+        '''
+        waiting = {}
+        for priority in PRIORITIES:
+            peeked = len(self.queue(self.shard_queue_name(shard, priority)).peek_messages(max_messages=max_messages - sum(waiting.values())))
+            if peeked:
+                waiting[priority] = peeked
+            if sum(waiting.values()) == max_messages:
+                break
+        if not waiting:
+            return False
+
+        lease_queue = self.lease_queue(shard)
+        leases = list(lease_queue.receive_messages(max_messages=sum(waiting.values()), visibility_timeout=self.lease_seconds))
+        has_more = len(leases) == max_messages
+        for priority, peeked in waiting.items():
+            if not leases:
+                break
+            source_queue = self.queue(self.shard_queue_name(shard, priority))
+            messages = list(source_queue.receive_messages(max_messages=min(peeked, len(leases)), visibility_timeout=VISIBILITY_TIMEOUT_SECONDS))
+            buffer.extend((source_queue, message, leases.pop()) for message in messages)
+        for lease in leases:
+            lease_queue.update_message(lease, visibility_timeout=0)
+        return has_more and not leases
+
+
+def get_storage_queue(connection_string, queue_name):
+    '''
+        Acquires a Storage queue client. Messages are base64 encoded as expected
+        by the Azure Functions queue trigger.
+    '''
+    return QueueClient.from_connection_string(
+        connection_string,
+        queue_name,
+        message_encode_policy=TextBase64EncodePolicy(),
+        message_decode_policy=TextBase64DecodePolicy()
+    )
+
+def get_task_scheduler():
+    '''
+        Returns the task scheduler of this worker process, creating it on first use,
+        or None if WatcherShardCount is not set.
+    '''
+    global task_scheduler
+    shard_count = int(os.environ.get('WatcherShardCount') or 0)
+    if task_scheduler is None and shard_count > 0:
+        shard_weights = os.environ.get('WatcherShardWeights')
+        task_scheduler = TaskScheduler(
+            lambda queue_name: get_storage_queue(os.environ['AzureWebJobsStorage'], queue_name),
+            shard_count,
+            shard_cap=int(os.environ.get('WatcherShardCap', 16)),
+            shard_weights=[int(weight) for weight in shard_weights.split(',')] if shard_weights else None,
+            target_depth=int(os.environ.get('WatcherSchedulerTargetDepth', 64)),
+            queue_prefix=os.environ.get('WatcherShardQueuePrefix', 'tasks'),
+            lease_seconds=int(os.environ.get('WatcherShardLeaseSeconds', LEASE_SECONDS))
+        )
+    return task_scheduler
@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient
+
+
+class SQLiteStore:
+    '''
+        Key/value store kept in a table of a local SQLite file. Suitable for
+        local development where all workers share one disk.
+    '''
+
+    def __init__(self, path, table):
+        self.table = table
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.lock, self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (scope TEXT, key TEXT, value BLOB, PRIMARY KEY (scope, key))')
+
+    def get(self, key, scope=''):
+        with self.lock:
+            row = self.connection.execute(f'SELECT value FROM {self.table} WHERE scope = ? AND key = ?', (scope, key)).fetchone()
+        return None if row is None else decode_value(row[0])
+
+    def put(self, key, value, scope=''):
+        with self.lock, self.connection:
+            self.connection.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)', (scope, key, encode_value(value)))
+
+    def delete(self, key, scope=''):
+        with self.lock, self.connection:
+            self.connection.execute(f'DELETE FROM {self.table} WHERE scope = ? AND key = ?', (scope, key))
+
+
+class BlobStore:
+    '''
+        Key/value store kept as one blob per key in {container}, under
+        {scope}/ if a scope is given. Blob names are hashes of the keys.
+    '''
+
+    def __init__(self, connection_string, container_name):
+        self.container_client = BlobServiceClient.from_connection_string(connection_string).get_container_client(container_name)
+        if not self.container_client.exists():
+            self.container_client.create_container()
+
+    def get(self, key, scope=''):
+        try:
+            return decode_value(self.container_client.download_blob(self.blob_name(key, scope)).readall())
+        except ResourceNotFoundError:
+            return None
+
+    def put(self, key, value, scope=''):
+        self.container_client.upload_blob(self.blob_name(key, scope), encode_value(value), overwrite=True)
+
+    def delete(self, key, scope=''):
+        try:
+            self.container_client.delete_blob(self.blob_name(key, scope))
+        except ResourceNotFoundError:
+            pass
+
+    def blob_name(self, key, scope):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return f'{scope}/{name}' if scope else name
+
+
+def encode_value(value):
+    return gzip.compress(json.dumps(value).encode('utf-8'))
+
+def decode_value(value):
+    return json.loads(gzip.decompress(value).decode('utf-8'))
+
+def get_store(setting_prefix, name):
+    '''
+        Creates the store configured by the {setting_prefix}Type, SQLitePath and
+        BlobContainer app settings, or returns None if {setting_prefix}Type is not
+        set. name is the default SQLite file name, table and blob container.
+    '''
+    store_type = os.environ.get(f'{setting_prefix}Type', '').lower()
+    if not store_type:
+        return None
+    if store_type == 'sqlite':
+        store = SQLiteStore(os.environ.get(f'{setting_prefix}SQLitePath', f'{name}.sqlite'), name)
+    elif store_type == 'blob':
+        store = BlobStore(os.environ['AzureWebJobsStorage'], os.environ.get(f'{setting_prefix}BlobContainer', name))
+    else:
+        raise ValueError('Received unexpected input.')
+    logging.info(f'Using {store_type} {name} store')
+    return store
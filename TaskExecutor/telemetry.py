@@ -0,0 +1,174 @@
+import atexit
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from . import ingestion
+
+REMAINING_READS_HEADER = 'x-ms-ratelimit-remaining-subscription-reads'
+SUBSCRIPTION_PATTERN = re.compile(r'/subscriptions/([^/?]+)', re.IGNORECASE)
+NULL_SPAN = contextlib.nullcontext()
+
+# Last seen remaining read quota per subscription, shared by all tasks of this worker.
+remaining_reads = {}
+current = threading.local()
+telemetry_spool = None
+
+
+def telemetry_enabled():
+    return os.environ.get('WatcherTelemetryEnabled', 'false').lower() == 'true'
+
+def client_hooks():
+    '''
+        Returns Azure SDK pipeline hooks that time every operation and record
+        throttling and remaining read quota, or no hooks if telemetry is disabled.
+        Hooks run after the retry policy, so every retry is observed. An
+        operation is timed from its first attempt to its last response, which
+        includes Retry-After and backoff sleeps between attempts.
+    '''
+    if not telemetry_enabled():
+        return {}
+    return {'raw_request_hook': on_request, 'raw_response_hook': on_response}
+
+def on_request(pipeline_request):
+    # Retries resend the same request, with the same context.
+    pipeline_request.context.setdefault('watcher_sent', time.perf_counter())
+
+def on_response(pipeline_response):
+    response = pipeline_response.http_response
+    subscription = SUBSCRIPTION_PATTERN.search(pipeline_response.http_request.url)
+    reads = response.headers.get(REMAINING_READS_HEADER)
+    if subscription is not None and reads is not None:
+        remaining_reads[subscription.group(1).lower()] = int(reads)
+
+    record = getattr(current, 'record', None)
+    if record is None:
+        return
+    # Every response adds the time since the previous one, so a retried operation
+    # adds up to the time from its first attempt to its last response.
+    context = pipeline_response.context
+    counted = context.get('watcher_counted', context.get('watcher_sent'))
+    if counted is not None:
+        now = time.perf_counter()
+        record['SdkMs'] += (now - counted) * 1000
+        context['watcher_counted'] = now
+    record['ApiCalls'] += 1
+    if response.status_code == 429:
+        record['Throttles'] += 1
+
+def span(name):
+    '''
+        Times a block of work for the current task, adding to its {name}Ms column.
+    '''
+    if getattr(current, 'record', None) is None:
+        return NULL_SPAN
+    return timed_span(current.record, f'{name}Ms')
+
+@contextlib.contextmanager
+def timed_span(record, column):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record[column] += (time.perf_counter() - started) * 1000
+
+def count(name, value=1):
+    record = getattr(current, 'record', None)
+    if record is not None:
+        record[name] += value
+
+def set_status(status):
+    record = getattr(current, 'record', None)
+    if record is not None:
+        record['Status'] = status
+
+def annotate(name, value):
+    record = getattr(current, 'record', None)
+    if record is not None:
+        record['AdditionalData'][name] = value
+
+@contextlib.contextmanager
+def task_telemetry(_input, msgin, subscription_id, task_id, monitor_client):
+    '''
+        Records one telemetry row per task: dequeue lag, time spent in Azure SDK
+        calls, flattening results, uploading, reading and writing the run manifest
+        and scheduling follow-up tasks, API calls, throttles, ingested rows and
+        bytes, and remaining read quota of the task's subscription. Rows are
+        batched into the WatcherTelemetry stream. Does nothing if
+        WatcherTelemetryEnabled is not set.
+
+        Dequeue lag is measured from the time the task was first enqueued,
+        including any wait in shard queues, if the message carries enqueuedAt.
+    '''
+    if not telemetry_enabled():
+        yield
+        return
+
+    started = time.perf_counter()
+    insertion_time = datetime.datetime.fromisoformat(_input['enqueuedAt']) if _input.get('enqueuedAt') else msgin.insertion_time
+    task_data = _input.get('taskData') or {}
+    record = {
+        'TimeGenerated': None,
+        'RunId': _input.get('runId'),
+        'CorrelationId': _input.get('correlationId'),
+        'TaskId': task_id,
+        'ParentTaskId': _input.get('parentTaskId'),
+        'Task': _input['task'],
+        'MetricType': task_data.get('metricType'),
+        'SubscriptionId': subscription_id,
+        'ResourceId': _input.get('rid'),
+        'Status': 'Succeeded',
+        'DequeueCount': msgin.dequeue_count,
+        'DequeueLagMs': None if insertion_time is None else round((datetime.datetime.now(datetime.timezone.utc) - insertion_time).total_seconds() * 1000, 1),
+        'DurationMs': 0.0,
+        'SdkMs': 0.0,
+        'FlattenMs': 0.0,
+        'UploadMs': 0.0,
+        'ManifestMs': 0.0,
+        'SchedulerMs': 0.0,
+        'OtherMs': 0.0,
+        'ApiCalls': 0,
+        'Throttles': 0,
+        'IngestedRows': 0,
+        'IngestedBytes': 0,
+        'RemainingSubscriptionReads': None,
+        'AdditionalData': {}
+    }
+    current.record = record
+    try:
+        yield
+    except Exception as e:
+        record['Status'] = 'Failed'
+        record['AdditionalData']['error'] = repr(e)
+        raise
+    finally:
+        current.record = None
+        record['TimeGenerated'] = datetime.datetime.utcnow().isoformat() + 'Z'
+        record['DurationMs'] = (time.perf_counter() - started) * 1000
+        # Everything not measured otherwise, e.g. topology cache and spool work.
+        measured = ('SdkMs', 'FlattenMs', 'UploadMs', 'ManifestMs', 'SchedulerMs')
+        record['OtherMs'] = max(0.0, record['DurationMs'] - sum(record[column] for column in measured))
+        for column in ('DurationMs', 'OtherMs') + measured:
+            record[column] = round(record[column], 1)
+        if subscription_id is not None:
+            record['RemainingSubscriptionReads'] = remaining_reads.get(subscription_id.lower())
+        logging.info(json.dumps(record))
+        try:
+            get_telemetry_spool(monitor_client).add('WatcherTelemetry', [record])
+        except Exception as e:
+            logging.warning(f'Failed to record telemetry: {e}')
+
+def get_telemetry_spool(monitor_client):
+    '''
+        Telemetry is always batched, independent of the AzureMonitorSpool* settings.
+    '''
+    global telemetry_spool
+    if telemetry_spool is None:
+        telemetry_spool = ingestion.LogSpool(monitor_client, max_rows=500, max_age_seconds=60)
+        atexit.register(telemetry_spool.flush_all)
+    return telemetry_spool
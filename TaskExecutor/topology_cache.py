@@ -0,0 +1,102 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from .helper import deserialize_cosmos_object, serialize_cosmos_object, today_utc
+from .store import get_store
+from .telemetry import annotate
+
+topology_cache = None
+
+
+def fingerprint(cosmos_object):
+    '''
+        Identifies the version of a listed resource. Databases and containers carry
+        an etag and _ts that change whenever they are modified. For resources
+        without either, a hash of their properties is used instead.
+    '''
+    resource = getattr(cosmos_object, 'resource', None)
+    for version in (getattr(resource, 'etag', None), getattr(resource, 'ts', None)):
+        if version is not None:
+            return str(version)
+    properties = json.dumps(cosmos_object.as_dict(), sort_keys=True, default=str)
+    return hashlib.sha256(properties.encode('utf-8')).hexdigest()
+
+def is_full_refresh_day():
+    '''
+        Every WatcherTopologyFullRefreshDays days all branches are listed again,
+        regardless of their TTL. Derived from the date so all workers agree.
+    '''
+    full_refresh_days = int(os.environ.get('WatcherTopologyFullRefreshDays', 7))
+    return full_refresh_days > 0 and today_utc().toordinal() % full_refresh_days == 0
+
+def is_fresh(entry):
+    '''
+        An entry is reused on the WatcherTopologyCacheTTLDays runs from the day it
+        was listed. Age is counted in days rather than hours, as runs do not start
+        at exactly the same time every night.
+    '''
+    fetched_day = datetime.datetime.fromisoformat(entry['fetchedAt']).date()
+    ttl_days = int(os.environ.get('WatcherTopologyCacheTTLDays', 3))
+    if (today_utc().date() - fetched_day).days >= ttl_days:
+        return False
+    # On a full refresh day, only entries listed earlier that same day are reused.
+    return not is_full_refresh_day() or fetched_day == today_utc().date()
+
+def list_children(parent, list_resources, leaf=False, reuse=True):
+    '''
+        Returns the children of a parent resource and whether they were served
+        from the topology cache. list_resources is called unless reuse is set
+        and the topology cache has a fresh entry for the parent.
+
+        Whenever a parent is listed, children whose fingerprint differs from the
+        previous listing are new or modified, so their own cached children are
+        dropped and get listed again further down the crawl. Children that are
+        no longer present are dropped as well. Leaf children, i.e. containers,
+        have nothing cached below them. Listings that are never reused only
+        record their children's fingerprints, for this comparison.
+    '''
+    cache = get_topology_cache()
+    if cache is None:
+        return list_resources(), False
+
+    # Resource IDs are case insensitive and ARM does not always return them in the same casing.
+    parent = parent.lower()
+    entry = cache.get(parent)
+    if reuse and entry is not None and is_fresh(entry):
+        annotate('topologyCache', 'Hit')
+        return [deserialize_cosmos_object(child['data']) for child in entry['children']], True
+
+    children = list_resources()
+    previous = {child['id']: child['fingerprint'] for child in entry['children']} if entry is not None else {}
+    current = [{'id': child.id.lower(), 'fingerprint': fingerprint(child)} for child in children]
+    if reuse:
+        for child, cached_child in zip(children, current):
+            cached_child['data'] = serialize_cosmos_object(child)
+    changed = [child['id'] for child in current if previous.get(child['id']) != child['fingerprint']]
+    removed = set(previous) - {child['id'] for child in current}
+    if not leaf:
+        for child_id in changed + list(removed):
+            cache.delete(child_id)
+    cache.put(parent, {'fetchedAt': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'children': current})
+    annotate('topologyCache', 'Miss' if entry is None else 'Refresh')
+    if entry is not None and (changed or removed):
+        logging.info(f'Topology of {parent} changed: {len(changed)} new or modified, {len(removed)} removed.')
+    return children, False
+
+def invalidate(parent):
+    cache = get_topology_cache()
+    if cache is not None:
+        cache.delete(parent.lower())
+
+def get_topology_cache():
+    '''
+        Returns the topology cache of this worker process, creating it on
+        first use, or None if WatcherTopologyCacheType is not set.
+    '''
+    global topology_cache
+    if topology_cache is None:
+        topology_cache = get_store('WatcherTopologyCache', 'topology')
+    return topology_cache
@@ -1,13 +1,19 @@
+import datetime
 import json
 import logging
 import typing
+import uuid
 
 import azure.functions as func
 
 def main(timer: func.TimerRequest, msgout: func.Out[typing.List[str]]):
     '''
         Wakes up on a timer and kickstarts the execution of subsequent tasks by 
-        submitting a message to Azure Storage Queue.
+        submitting a message to Azure Storage Queue. The run id is the UTC date,
+        so restarting the same night's run resumes it instead of starting over.
+        The correlation id follows every task spawned from this message.
     '''
 
-    msgout.set([json.dumps({'task': 'ListVisibleSubscriptions'})])
+    run_id = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+    enqueued_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    msgout.set([json.dumps({'task': 'ListVisibleSubscriptions', 'runId': run_id, 'correlationId': str(uuid.uuid4()), 'enqueuedAt': enqueued_at})])
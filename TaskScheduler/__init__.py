@@ -0,0 +1,17 @@
+import logging
+
+import azure.functions as func
+from ..TaskExecutor.scheduler import get_task_scheduler
+
+def main(timer: func.TimerRequest):
+    '''
+        Wakes up every few seconds and feeds tasks from the per-subscription shard
+        queues into the tasks queue. TaskExecutor also drains after every task;
+        this keeps the crawl moving if the tasks queue runs dry.
+        Does nothing unless WatcherShardCount is set. Disabled by default, enable
+        it with the AzureWebJobs.TaskScheduler.Disabled app setting when sharding is on.
+    '''
+
+    task_scheduler = get_task_scheduler()
+    if task_scheduler is not None:
+        task_scheduler.drain()
@@ -0,0 +1,119 @@
+'''
+    Checks TaskScheduler against in-memory queues: task priorities, per-shard
+    in-flight caps held by leases, weighted draining, and the number of Storage
+    calls a drain costs, with and without waiting tasks. Run from the repository root:
+
+        python -m benchmarks.check_scheduler
+'''
+import json
+
+from TaskExecutor import scheduler
+
+# Of two shards, SUBSCRIPTION_A maps to shard 1 and SUBSCRIPTION_B to shard 0.
+SUBSCRIPTION_A = '00000000-0000-0000-0000-00000000000a'
+SUBSCRIPTION_B = '00000000-0000-0000-0000-00000000000d'
+
+
+def new_scheduler(shard_count=2, shard_cap=3, shard_weights=None, target_depth=100):
+    queues = {}
+    task_scheduler = scheduler.TaskScheduler(lambda name: queues.setdefault(name, scheduler.InMemoryQueue()), shard_count, shard_cap=shard_cap, shard_weights=shard_weights, target_depth=target_depth)
+    return task_scheduler, queues
+
+def task(task_name, subscription_id, name):
+    return json.dumps({'task': task_name, 'rid': f'/subscriptions/{subscription_id}/resourceGroups/rg/providers/Microsoft.DocumentDB/databaseAccounts/{name}'})
+
+def forwarded_tasks(queues):
+    tasks_queue = queues['tasks']
+    messages = tasks_queue.receive_messages(max_messages=len(tasks_queue.messages))
+    for message in messages:
+        tasks_queue.delete_message(message)
+    return [json.loads(message.content) for message in messages]
+
+def shard_of(subscription_id, shard_count=2):
+    return scheduler.shard_for(subscription_id, shard_count)
+
+def check_priorities():
+    task_scheduler, queues = new_scheduler(shard_cap=2)
+    task_scheduler.enqueue([task('GetCosmosContainerMetrics', SUBSCRIPTION_A, f'metrics{i}') for i in range(3)])
+    task_scheduler.enqueue([task('ListCosmosDatabases', SUBSCRIPTION_A, 'discovery')])
+    tasks = forwarded_tasks(queues) if task_scheduler.drain() else []
+    assert [t['task'] for t in tasks] == ['ListCosmosDatabases', 'GetCosmosContainerMetrics'], tasks
+
+def check_in_flight_cap():
+    task_scheduler, queues = new_scheduler(shard_cap=3)
+    shard = shard_of(SUBSCRIPTION_A)
+    task_scheduler.enqueue([task('GetCosmosContainerMetrics', SUBSCRIPTION_A, f'metrics{i}') for i in range(10)])
+
+    tasks = forwarded_tasks(queues) if task_scheduler.drain() else []
+    assert len(tasks) == 3 and all(t['shardLease']['shard'] == shard for t in tasks), tasks
+    # Draining again forwards nothing until a task finishes, however often it runs.
+    assert task_scheduler.drain()[shard] == 0
+    assert task_scheduler.drain([shard])[shard] == 0
+
+    task_scheduler.release(tasks[0]['shardLease'])
+    assert task_scheduler.drain([shard])[shard] == 1
+    # Releasing a lease twice, e.g. when a failed task is retried, is harmless.
+    task_scheduler.release(tasks[0]['shardLease'])
+    assert task_scheduler.drain([shard])[shard] == 0
+
+def check_small_shard_not_starved():
+    task_scheduler, queues = new_scheduler(shard_cap=4, target_depth=4)
+    task_scheduler.enqueue([task('GetCosmosContainerMetrics', SUBSCRIPTION_A, f'metrics{i}') for i in range(100)])
+    task_scheduler.enqueue([task('GetCosmosContainerMetrics', SUBSCRIPTION_B, f'metrics{i}') for i in range(2)])
+    forwarded = task_scheduler.drain()
+    assert forwarded[shard_of(SUBSCRIPTION_B)] == 2, forwarded
+    # Messages received but not forwarded are visible again, and so are their leases.
+    shard_a = shard_of(SUBSCRIPTION_A)
+    assert not queues[f'tasks-{shard_a}-p2'].invisible
+    assert len(queues[f'tasks-{shard_a}-leases'].invisible) == forwarded[shard_a], forwarded
+
+def check_weights():
+    task_scheduler, queues = new_scheduler(shard_cap=30, shard_weights=[3, 1], target_depth=8)
+    for subscription_id in (SUBSCRIPTION_A, SUBSCRIPTION_B):
+        task_scheduler.enqueue([task('GetCosmosContainerMetrics', subscription_id, f'metrics{i}') for i in range(20)])
+    forwarded = task_scheduler.drain()
+    assert forwarded == [6, 2], forwarded
+
+def check_drain_cost():
+    '''
+        A task draining the shard it freed a lease in costs a handful of calls,
+        independent of the number of shards.
+    '''
+    task_scheduler, queues = new_scheduler(shard_count=8, shard_cap=1)
+    task_scheduler.enqueue([task('GetCosmosContainerMetrics', SUBSCRIPTION_A, f'metrics{i}') for i in range(5)])
+    tasks = forwarded_tasks(queues) if task_scheduler.drain() else []
+    calls = sum(queue.calls for queue in queues.values())
+    task_scheduler.release(tasks[0]['shardLease'])
+    task_scheduler.drain([tasks[0]['shardLease']['shard']])
+    calls = sum(queue.calls for queue in queues.values()) - calls
+    # Queue depth, 3 peeks, 1 lease and 1 task received, forwarded and deleted, and the lease released.
+    assert calls <= 9, calls
+
+def check_idle_drain_cost():
+    '''
+        Idle shards only cost a peek per priority. Shards at their cap cost one
+        more call, and hand no leases back.
+    '''
+    task_scheduler, queues = new_scheduler(shard_count=8, shard_cap=16)
+    task_scheduler.drain()
+    calls = sum(queue.calls for queue in queues.values())
+    task_scheduler.drain()
+    calls = sum(queue.calls for queue in queues.values()) - calls
+    assert calls == 1 + 8 * len(scheduler.PRIORITIES), calls
+
+    task_scheduler, queues = new_scheduler(shard_count=8, shard_cap=1)
+    task_scheduler.enqueue([task('GetCosmosContainerMetrics', SUBSCRIPTION_A, f'metrics{i}') for i in range(5)])
+    task_scheduler.drain()
+    calls = sum(queue.calls for queue in queues.values())
+    task_scheduler.drain()
+    calls = sum(queue.calls for queue in queues.values()) - calls
+    assert calls == 1 + 8 * len(scheduler.PRIORITIES) + 1, calls
+
+def main():
+    for check in (check_priorities, check_in_flight_cap, check_small_shard_not_starved, check_weights, check_drain_cost, check_idle_drain_cost):
+        check()
+        print(f'{check.__name__}: ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+'''
+    Checks LogSpool crash recovery and flush failures against a local directory:
+    which write-ahead files are adopted from dead workers, that each is uploaded
+    once even if workers start concurrently, what happens to rows whose upload
+    fails, and when units waiting for their spooled rows are completed. Run from the repository root:
+
+        python -m benchmarks.check_spool
+'''
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+
+from azure.core.exceptions import HttpResponseError
+
+from TaskExecutor import ingestion
+
+TABLE = 'ContainersConfig'
+
+
+class RecordingClient:
+    '''
+        Stands in for LogsIngestionClient. Fails with the given errors first.
+    '''
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.rows = []
+
+    def upload(self, rule_id, stream_name, logs, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.rows.extend(logs)
+
+
+class BlockingClient(RecordingClient):
+    '''
+        Blocks the first upload until released, to keep a flush in flight.
+    '''
+
+    def __init__(self, errors=()):
+        super().__init__(errors)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def upload(self, rule_id, stream_name, logs, **kwargs):
+        if not self.started.is_set():
+            self.started.set()
+            self.release.wait()
+        super().upload(rule_id, stream_name, logs, **kwargs)
+
+
+def configure():
+    os.environ[f'AzureMonitorDataCollectionRuleId{TABLE}'] = 'dcr-check'
+    os.environ[f'AzureMonitorDataCollectionStreamName{TABLE}'] = f'Custom-{TABLE}_CL'
+    ingestion.RETRY_BACKOFF_SECONDS = 0
+
+def http_error(status_code):
+    error = HttpResponseError(message=f'status {status_code}')
+    error.status_code = status_code
+    return error
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def write_wal(directory, file_name, rows):
+    with open(os.path.join(directory, file_name), 'w', encoding='utf-8') as wal:
+        wal.write(''.join(json.dumps(row) + '\n' for row in rows))
+
+def new_spool(client, directory=None, **kwargs):
+    # Long max age, so only explicit flushes upload.
+    return ingestion.LogSpool(client, max_age_seconds=3600, wal_directory=directory, **kwargs)
+
+def check_recovery():
+    with tempfile.TemporaryDirectory() as directory:
+        dead = dead_pid()
+        live = os.getppid()
+        write_wal(directory, f'{TABLE}.{dead}.{uuid.uuid4().hex}.wal', [{'row': 'dead'}])
+        write_wal(directory, f'{TABLE}.{dead}.{uuid.uuid4().hex}.wal.3.flushing', [{'row': 'dead-flushing'}])
+        write_wal(directory, f'{TABLE}.{dead}.{uuid.uuid4().hex}.wal.1.recovered', [{'row': 'dead-recovered'}])
+        # A restarted worker may get the PID of the one that crashed.
+        write_wal(directory, f'{TABLE}.{os.getpid()}.{uuid.uuid4().hex}.wal', [{'row': 'reused-pid'}])
+        write_wal(directory, f'{TABLE}.{live}.{uuid.uuid4().hex}.wal', [{'row': 'live'}])
+        write_wal(directory, f'{TABLE}.{dead}.{uuid.uuid4().hex}.failed.2.flushing', [{'row': 'failed'}])
+
+        client = RecordingClient()
+        new_spool(client, directory)
+        rows = sorted(row['row'] for row in client.rows)
+        assert rows == ['dead', 'dead-flushing', 'dead-recovered', 'reused-pid'], rows
+        remaining = sorted(file_name.split('.')[1] + '.' + file_name.split('.')[3] for file_name in os.listdir(directory))
+        assert remaining == sorted([f'{dead}.failed', f'{live}.wal']), remaining
+
+def recover_in_process(directory, results):
+    # Runs in a separate process, which has its own ingestion.PROCESS_ID.
+    configure()
+    client = RecordingClient()
+    new_spool(client, directory)
+    results.put([row['row'] for row in client.rows])
+
+def check_concurrent_recovery():
+    with tempfile.TemporaryDirectory() as directory:
+        dead = dead_pid()
+        expected = []
+        for i in range(50):
+            write_wal(directory, f'{TABLE}.{dead}.{uuid.uuid4().hex}.wal', [{'row': i}])
+            expected.append(i)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        workers = [context.Process(target=recover_in_process, args=(directory, results)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        rows = sorted(row for _ in workers for row in results.get(timeout=60))
+        for worker in workers:
+            worker.join()
+        assert rows == expected, rows
+        assert not os.listdir(directory), os.listdir(directory)
+
+def check_transient_failure_is_kept():
+    with tempfile.TemporaryDirectory() as directory:
+        client = RecordingClient([http_error(503)] * ingestion.MAX_ATTEMPTS)
+        spool = new_spool(client, directory)
+        spool.add(TABLE, [{'row': 1}])
+        spool.flush(TABLE)
+        assert spool.buffers[TABLE]['logs'] == [{'row': 1}]
+        spool.flush(TABLE)
+        assert client.rows == [{'row': 1}] and not spool.buffers[TABLE]['logs']
+        assert not os.listdir(directory), os.listdir(directory)
+
+def check_permanent_failure_is_dropped():
+    with tempfile.TemporaryDirectory() as directory:
+        client = RecordingClient([http_error(400)])
+        spool = new_spool(client, directory)
+        spool.add(TABLE, [{'row': 1}])
+        spool.flush(TABLE)
+        assert not spool.buffers[TABLE]['logs'] and not client.rows
+        # Kept for inspection, but never recovered.
+        assert [file_name.split('.')[3] for file_name in os.listdir(directory)] == ['failed'], os.listdir(directory)
+
+def check_missing_stream_config_is_dropped():
+    client = RecordingClient()
+    spool = new_spool(client)
+    spool.add('UnconfiguredTable', [{'row': 1}])
+    spool.flush('UnconfiguredTable')
+    assert not spool.buffers['UnconfiguredTable']['logs']
+
+def check_buffered_bytes_are_capped():
+    row_bytes = len(json.dumps({'row': 0}).encode('utf-8'))
+    client = RecordingClient([http_error(503)] * ingestion.MAX_ATTEMPTS * 3)
+    spool = new_spool(client, max_buffered_bytes=2 * row_bytes)
+    for i in range(2):
+        spool.add(TABLE, [{'row': i}])
+        spool.flush(TABLE)
+    assert spool.buffers[TABLE]['logs'] == [{'row': 0}, {'row': 1}], spool.buffers[TABLE]['logs']
+    # Once the retried rows outgrow the cap, they are dropped.
+    spool.add(TABLE, [{'row': 2}])
+    spool.flush(TABLE)
+    assert not spool.buffers[TABLE]['logs'], spool.buffers[TABLE]['logs']
+
+def flush_in_flight(spool, client):
+    '''
+        Starts flushing on another thread, as the age timer would, and returns
+        once its upload is in flight.
+    '''
+    flush = threading.Thread(target=spool.flush, args=(TABLE,), daemon=True)
+    flush.start()
+    client.started.wait()
+    return flush
+
+def check_callback_waits_for_in_flight_flush():
+    client = BlockingClient([http_error(503)] * ingestion.MAX_ATTEMPTS)
+    spool = new_spool(client)
+    spool.add(TABLE, [{'row': 1}])
+    flush = flush_in_flight(spool, client)
+    completed = []
+    spool.after_flush([TABLE], lambda: completed.append(True))
+    assert not completed
+    client.release.set()
+    flush.join()
+    # The flush failed, so the unit is complete only once its rows are flushed again.
+    assert not completed and spool.buffers[TABLE]['logs'] == [{'row': 1}]
+    spool.flush(TABLE)
+    assert completed and client.rows == [{'row': 1}]
+
+def check_callback_not_called_for_dropped_rows():
+    client = BlockingClient([http_error(400)])
+    spool = new_spool(client)
+    spool.add(TABLE, [{'row': 1}])
+    flush = flush_in_flight(spool, client)
+    completed = []
+    spool.after_flush([TABLE], lambda: completed.append(True))
+    client.release.set()
+    flush.join()
+    assert not completed and not spool.buffers[TABLE]['logs']
+
+def main():
+    configure()
+    for check in (check_recovery, check_concurrent_recovery, check_transient_failure_is_kept, check_permanent_failure_is_dropped,
+                  check_missing_stream_config_is_dropped, check_buffered_bytes_are_capped, check_callback_waits_for_in_flight_flush,
+                  check_callback_not_called_for_dropped_rows):
+        check()
+        print(f'{check.__name__}: ok')
+
+
+if __name__ == '__main__':
+    main()
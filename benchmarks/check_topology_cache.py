@@ -0,0 +1,75 @@
+'''
+    Checks the topology cache against crawls of a simulated estate: container
+    listings are reused on the next crawl, and containers deleted since are
+    neither logged nor mislabelled, however their database provisions
+    throughput. Run from the repository root:
+
+        python -m benchmarks.check_topology_cache
+'''
+from TaskExecutor import store
+
+from .estate import Estate, SimulationClock
+from .run_crawl import run
+
+
+def crawl(estate, topology):
+    results = run(estate, SimulationClock(seed=0), workers=8, metric_sample_ratio=0.0, topology=topology)
+    assert not results['failed_tasks'], results['failed_tasks']
+    rows = sum(stream['rows'] for name, stream in results['ingestion'].items() if 'ContainersConfig' in name)
+    return results['api_calls'].get('list_containers', 0), rows
+
+def new_estate():
+    return Estate(subscriptions=2, accounts=10, databases_per_account=2, containers_per_database=5, shared_database_ratio=0.3, serverless_ratio=0.0, seed=3)
+
+def database_rids(estate, shared):
+    '''
+        Returns databases whose throughput is shared, or not, with more than one container.
+    '''
+    return [
+        database.id for account_name, databases in estate.databases.items() for database in databases
+        if (estate.throughput[database.id] is not None) == shared and len(estate.containers[(account_name, database.resource.id)]) > 1
+    ]
+
+def delete_container(estate, database_rid):
+    account_name, database_name = database_rid.split('/')[8], database_rid.split('/')[10]
+    return estate.containers[(account_name, database_name)].pop(0)
+
+def check_listings_reused():
+    estate = new_estate()
+    topology = store.SQLiteStore(':memory:', 'topology')
+    listed, rows = crawl(estate, topology)
+    relisted, cached_rows = crawl(estate, topology)
+    # Only databases with shared throughput have their containers listed again.
+    shared = sum(1 for databases in estate.databases.values() for database in databases if estate.throughput[database.id] is not None)
+    assert relisted == shared, (listed, relisted, shared)
+    assert relisted < listed and cached_rows == rows == estate.container_count(), (rows, cached_rows)
+
+def check_deleted_container_with_dedicated_throughput():
+    estate = new_estate()
+    topology = store.SQLiteStore(':memory:', 'topology')
+    crawl(estate, topology)
+    database_rid = database_rids(estate, shared=False)[0]
+    delete_container(estate, database_rid)
+    _, rows = crawl(estate, topology)
+    assert rows == estate.container_count(), rows
+    # The database's listing is dropped, so the next crawl lists its containers again.
+    assert topology.get(database_rid.lower()) is None
+    crawl(estate, topology)
+    assert topology.get(database_rid.lower()) is not None
+
+def check_deleted_container_with_shared_throughput():
+    estate = new_estate()
+    topology = store.SQLiteStore(':memory:', 'topology')
+    crawl(estate, topology)
+    delete_container(estate, database_rids(estate, shared=True)[0])
+    _, rows = crawl(estate, topology)
+    assert rows == estate.container_count(), rows
+
+def main():
+    for check in (check_listings_reused, check_deleted_container_with_dedicated_throughput, check_deleted_container_with_shared_throughput):
+        check()
+        print(f'{check.__name__}: ok')
+
+
+if __name__ == '__main__':
+    main()
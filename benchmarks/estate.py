@@ -0,0 +1,375 @@
+import json
+import math
+import random
+import threading
+import types
+import uuid
+
+from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from azure.mgmt.cosmosdb import models
+from azure.mgmt.subscription.models import Subscription
+
+API_KINDS = {'NoSQL': 0.6, 'Mongo': 0.2, 'Cassandra': 0.08, 'Gremlin': 0.06, 'Table': 0.06}
+API_CAPABILITIES = {'NoSQL': None, 'Mongo': 'EnableMongo', 'Cassandra': 'EnableCassandra', 'Table': 'EnableTable', 'Gremlin': 'EnableGremlin'}
+REGIONS = ['West US', 'East US', 'North Europe', 'West Europe', 'Southeast Asia']
+OPERATION_TYPES = ['Query', 'Read', 'Create', 'Replace', 'ReadFeed']
+
+# Median simulated latency per API call type, in seconds.
+API_LATENCIES = {
+    'subscriptions.list': 0.3,
+    'database_accounts.list': 0.5,
+    'service.list': 0.15,
+    'list_databases': 0.2,
+    'list_containers': 0.2,
+    'get_database_throughput': 0.12,
+    'get_container_throughput': 0.12,
+    'metrics.query_resource': 0.4,
+    'ingestion.upload': 0.25
+}
+DEFAULT_RETRY_AFTER_SECONDS = 5
+# Azure Resource Manager limits reads per subscription with a token bucket, refilled
+# continuously. Subscription listing and ingestion are not subject to it.
+DEFAULT_READ_QUOTA_BURST = 250
+DEFAULT_READ_QUOTA_RATE = 25
+
+
+class SimulationClock:
+    '''
+        Accumulates simulated latency and counts API calls for the task that is
+        currently executing. Fake clients charge every call to the clock instead
+        of sleeping, which lets the harness simulate large estates quickly.
+
+        Reads of each subscription draw from a token bucket of read_quota_burst
+        tokens refilled at read_quota_rate per second of simulated time. A read
+        finding the bucket empty is throttled with a Retry-After of the time until
+        the next token. Independently, any call is throttled with probability
+        throttle_rate and retried after retry_after_seconds.
+    '''
+
+    def __init__(self, seed=0, latency_scale=1.0, throttle_rate=0.0, retry_after_seconds=DEFAULT_RETRY_AFTER_SECONDS,
+                 read_quota_burst=DEFAULT_READ_QUOTA_BURST, read_quota_rate=DEFAULT_READ_QUOTA_RATE):
+        self.random = random.Random(seed)
+        self.latency_scale = latency_scale
+        self.throttle_rate = throttle_rate
+        self.retry_after_seconds = retry_after_seconds
+        self.read_quota_burst = read_quota_burst
+        self.read_quota_rate = read_quota_rate
+        self.lock = threading.Lock()
+        self.task_started = 0.0
+        self.task_latency = 0.0
+        self.read_quotas = {}
+        self.api_calls = {}
+        self.throttles = {}
+        self.subscription_throttles = {}
+
+    def charge(self, api, subscription_id=None):
+        '''
+            Records one API call, a read against subscription_id's quota if given.
+            Throttled calls are retried after their Retry-After, the same way the
+            SDK retry policy would, and each retry counts as a call.
+        '''
+        with self.lock:
+            latency = 0.0
+            while True:
+                self.api_calls[api] = self.api_calls.get(api, 0) + 1
+                latency += API_LATENCIES[api] * self.latency_scale * self.random.lognormvariate(0, 0.5)
+                retry_after = self.take_read(subscription_id, self.task_started + self.task_latency + latency) if subscription_id else None
+                if retry_after is None and self.random.random() < self.throttle_rate:
+                    retry_after = self.retry_after_seconds
+                if retry_after is None:
+                    break
+                self.throttles[api] = self.throttles.get(api, 0) + 1
+                if subscription_id:
+                    self.subscription_throttles[subscription_id] = self.subscription_throttles.get(subscription_id, 0) + 1
+                latency += retry_after
+            self.task_latency += latency
+
+    def take_read(self, subscription_id, now):
+        '''
+            Takes a token from the subscription's read quota. Returns None if one was
+            available, otherwise the Retry-After in whole seconds. Tasks are simulated
+            one after another, so calls can arrive slightly out of time order; the
+            bucket is only refilled forward in time.
+        '''
+        if not self.read_quota_rate:
+            return None
+        quota = self.read_quotas.setdefault(subscription_id, {'tokens': float(self.read_quota_burst), 'updated': now})
+        if now > quota['updated']:
+            quota['tokens'] = min(self.read_quota_burst, quota['tokens'] + (now - quota['updated']) * self.read_quota_rate)
+            quota['updated'] = now
+        if quota['tokens'] >= 1:
+            quota['tokens'] -= 1
+            return None
+        return max(1, math.ceil((1 - quota['tokens']) / self.read_quota_rate))
+
+    def start_task(self, now=0.0):
+        with self.lock:
+            self.task_started = now
+            self.task_latency = 0.0
+
+    def end_task(self):
+        with self.lock:
+            return self.task_latency
+
+
+class Estate:
+    '''
+        Generates a synthetic Cosmos DB estate. Accounts are spread across
+        subscriptions with skew controlling the share that lands in the first
+        subscription, the rest being split evenly.
+    '''
+
+    def __init__(self, subscriptions=2, accounts=10, databases_per_account=2, containers_per_database=5, skew=0.0,
+                 serverless_ratio=0.15, shared_database_ratio=0.3, dedicated_in_shared_ratio=0.2, max_partitions=8, seed=0):
+        self.random = random.Random(seed)
+        self.subscriptions = []
+        self.accounts = {}
+        self.databases = {}
+        self.containers = {}
+        self.throughput = {}
+        self.partitions = {}
+        self.regions = {}
+
+        for i in range(subscriptions):
+            subscription_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+            # Subscription properties are read-only, as they are only ever set by deserialization.
+            subscription = Subscription()
+            subscription.id = f'/subscriptions/{subscription_id}'
+            subscription.subscription_id = subscription_id
+            subscription.display_name = f'subscription-{i}'
+            self.subscriptions.append(subscription)
+            self.accounts[subscription_id] = []
+
+        skewed_accounts = int(accounts * skew) if subscriptions > 1 else 0
+        other_subscriptions = self.subscriptions[1:] if skewed_accounts else self.subscriptions
+        for i in range(accounts):
+            if i < skewed_accounts:
+                subscription = self.subscriptions[0]
+            else:
+                subscription = other_subscriptions[(i - skewed_accounts) % len(other_subscriptions)]
+            self.add_account(subscription, f'account{i}', databases_per_account, containers_per_database, serverless_ratio, shared_database_ratio, dedicated_in_shared_ratio, max_partitions)
+
+    def add_account(self, subscription, account_name, databases_per_account, containers_per_database, serverless_ratio, shared_database_ratio, dedicated_in_shared_ratio, max_partitions):
+        api_kind = self.random.choices(list(API_KINDS), weights=list(API_KINDS.values()))[0]
+        is_serverless = self.random.random() < serverless_ratio
+        account_rid = f'{subscription.id}/resourceGroups/rg-{account_name}/providers/Microsoft.DocumentDB/databaseAccounts/{account_name}'
+        capabilities = [models.Capability(name=name) for name in (API_CAPABILITIES[api_kind], 'EnableServerless' if is_serverless else None) if name]
+        account = models.DatabaseAccountGetResults(location='westus', capabilities=capabilities, consistency_policy=models.ConsistencyPolicy(default_consistency_level='Session'))
+        account.__setattr__('id', account_rid)
+        account.__setattr__('locations', [models.Location(location_name=region, failover_priority=i) for i, region in enumerate(self.random.sample(REGIONS, self.random.randint(1, 3)))])
+        account.__setattr__('read_locations', account.locations)
+        self.accounts[subscription.subscription_id].append(account)
+        self.regions[account_name] = [location.location_name for location in account.locations]
+
+        database_names = ['TablesDB'] if api_kind == 'Table' else [f'db{i}' for i in range(databases_per_account)]
+        databases = []
+        for database_name in database_names:
+            database_rid = f'{account_rid}/{database_segment(api_kind)}/{database_name}'
+            database = database_model(api_kind, database_name)
+            database.__setattr__('id', database_rid)
+            if api_kind != 'Table':
+                databases.append(database)
+            is_shared = not is_serverless and api_kind != 'Table' and self.random.random() < shared_database_ratio
+            self.throughput[database_rid] = 'Serverless' if is_serverless else (throughput_model(self.random) if is_shared else None)
+
+            containers = []
+            container_count = containers_per_database * databases_per_account if api_kind == 'Table' else containers_per_database
+            for i in range(container_count):
+                container_name = f'container{i}'
+                container_rid = f'{account_rid}/tables/{container_name}' if api_kind == 'Table' else f'{database_rid}/{container_segment(api_kind)}/{container_name}'
+                container = container_model(api_kind, container_name)
+                container.__setattr__('id', container_rid)
+                containers.append(container)
+                if is_serverless:
+                    self.throughput[container_rid] = 'Serverless'
+                elif is_shared and self.random.random() >= dedicated_in_shared_ratio:
+                    self.throughput[container_rid] = None
+                else:
+                    self.throughput[container_rid] = throughput_model(self.random)
+                self.partitions[(account_name, database_name, container_name)] = self.random.randint(1, max_partitions)
+            self.containers[(account_name, database_name)] = containers
+        self.databases[account_name] = databases
+
+    def container_count(self):
+        return sum(len(containers) for containers in self.containers.values())
+
+    def throughput_for(self, rid):
+        throughput = self.throughput.get(rid)
+        if throughput == 'Serverless':
+            error = HttpResponseError(message='Reading or replacing offers is not supported for serverless accounts.')
+            error.status_code = 400
+            raise error
+        if throughput is None:
+            raise ResourceNotFoundError()
+        return throughput
+
+
+def database_segment(api_kind):
+    return {'NoSQL': 'sqlDatabases', 'Mongo': 'mongodbDatabases', 'Cassandra': 'cassandraKeyspaces', 'Gremlin': 'gremlinDatabases', 'Table': 'dbs'}[api_kind]
+
+def container_segment(api_kind):
+    return {'NoSQL': 'containers', 'Mongo': 'collections', 'Cassandra': 'tables', 'Gremlin': 'graphs'}[api_kind]
+
+def default_indexing_policy():
+    return models.IndexingPolicy(automatic=True, indexing_mode='consistent', included_paths=[models.IncludedPath(path='/*')], excluded_paths=[models.ExcludedPath(path='/"_etag"/?')])
+
+def database_model(api_kind, name):
+    if api_kind == 'Mongo':
+        return models.MongoDBDatabaseGetResults(resource=models.MongoDBDatabaseGetPropertiesResource(id=name))
+    elif api_kind == 'Cassandra':
+        return models.CassandraKeyspaceGetResults(resource=models.CassandraKeyspaceGetPropertiesResource(id=name))
+    elif api_kind == 'Gremlin':
+        return models.GremlinDatabaseGetResults(resource=models.GremlinDatabaseGetPropertiesResource(id=name))
+    return models.SqlDatabaseGetResults(resource=models.SqlDatabaseGetPropertiesResource(id=name))
+
+def container_model(api_kind, name):
+    if api_kind == 'NoSQL':
+        return models.SqlContainerGetResults(resource=models.SqlContainerGetPropertiesResource(id=name, indexing_policy=default_indexing_policy(), partition_key=models.ContainerPartitionKey(paths=['/pk'])))
+    elif api_kind == 'Mongo':
+        return models.MongoDBCollectionGetResults(resource=models.MongoDBCollectionGetPropertiesResource(id=name, indexes=[models.MongoIndex(key=models.MongoIndexKeys(keys=['_id']))]))
+    elif api_kind == 'Cassandra':
+        return models.CassandraTableGetResults(resource=models.CassandraTableGetPropertiesResource(id=name))
+    elif api_kind == 'Table':
+        return models.TableGetResults(resource=models.TableGetPropertiesResource(id=name))
+    elif api_kind == 'Gremlin':
+        return models.GremlinGraphGetResults(resource=models.GremlinGraphGetPropertiesResource(id=name, indexing_policy=default_indexing_policy()))
+
+def throughput_model(rng):
+    if rng.random() < 0.5:
+        resource = models.ThroughputSettingsGetPropertiesResource(throughput=400 * rng.randint(1, 25))
+    else:
+        resource = models.ThroughputSettingsGetPropertiesResource(autoscale_settings=models.AutoscaleSettingsResource(max_throughput=1000 * rng.randint(1, 20)))
+    return models.ThroughputSettingsGetResults(resource=resource)
+
+
+class FakeSubscriptionClient:
+
+    def __init__(self, estate, clock):
+        self.subscriptions = types.SimpleNamespace(list=lambda: self.list_subscriptions(estate, clock))
+
+    def list_subscriptions(self, estate, clock):
+        clock.charge('subscriptions.list')
+        return iter(estate.subscriptions)
+
+
+class FakeCosmosDBManagementClient:
+    '''
+        Stands in for CosmosDBManagementClient of a single subscription. Exposes
+        the operation groups used by TaskExecutor for all API kinds.
+    '''
+
+    def __init__(self, estate, clock, subscription_id):
+        self.estate = estate
+        self.clock = clock
+        self.subscription_id = subscription_id
+        self.database_accounts = types.SimpleNamespace(list=lambda: self.call('database_accounts.list', lambda: estate.accounts[subscription_id]))
+        self.service = types.SimpleNamespace(list=lambda resource_group, account_name: self.call('service.list', lambda: []))
+        self.sql_resources = self.resources(
+            list_sql_databases='databases', list_sql_containers='containers',
+            get_sql_database_throughput='database_throughput', get_sql_container_throughput='container_throughput')
+        self.mongo_db_resources = self.resources(
+            list_mongo_db_databases='databases', list_mongo_db_collections='containers',
+            get_mongo_db_database_throughput='database_throughput', get_mongo_db_collection_throughput='container_throughput')
+        self.cassandra_resources = self.resources(
+            list_cassandra_keyspaces='databases', list_cassandra_tables='containers',
+            get_cassandra_keyspace_throughput='database_throughput', get_cassandra_table_throughput='container_throughput')
+        self.gremlin_resources = self.resources(
+            list_gremlin_databases='databases', list_gremlin_graphs='containers',
+            get_gremlin_database_throughput='database_throughput', get_gremlin_graph_throughput='container_throughput')
+        self.table_resources = self.resources(list_tables='containers', get_table_throughput='container_throughput')
+
+    def call(self, api, result):
+        self.clock.charge(api, self.subscription_id)
+        return iter(result())
+
+    def resources(self, **operations):
+        handlers = {
+            'databases': lambda **kwargs: self.call('list_databases', lambda: self.estate.databases[kwargs['account_name']]),
+            'containers': lambda **kwargs: self.call('list_containers', lambda: self.estate.containers[(kwargs['account_name'], database_name_arg(kwargs))]),
+            'database_throughput': lambda **kwargs: self.get_throughput('get_database_throughput', kwargs, database_rid=True),
+            'container_throughput': lambda **kwargs: self.get_throughput('get_container_throughput', kwargs, database_rid=False)
+        }
+        return types.SimpleNamespace(**{operation: handlers[kind] for operation, kind in operations.items()})
+
+    def get_throughput(self, api, kwargs, database_rid):
+        self.clock.charge(api, self.subscription_id)
+        account_name = kwargs['account_name']
+        database_name = database_name_arg(kwargs)
+        if database_rid:
+            resources, name = self.estate.databases.get(account_name, []), database_name
+        else:
+            resources, name = self.estate.containers.get((account_name, database_name), []), container_name_arg(kwargs)
+        resource = next((resource for resource in resources if resource.resource.id == name), None)
+        if resource is None:
+            # Deleted since it was listed.
+            raise ResourceNotFoundError()
+        return self.estate.throughput_for(resource.id)
+
+
+def database_name_arg(kwargs):
+    return kwargs.get('database_name') or kwargs.get('keyspace_name') or 'TablesDB'
+
+def container_name_arg(kwargs):
+    return kwargs.get('container_name') or kwargs.get('collection_name') or kwargs.get('table_name') or kwargs.get('graph_name')
+
+
+class FakeMetricsQueryClient:
+    '''
+        Stands in for MetricsQueryClient. Returns one data point per granularity
+        interval of the requested timespan, scaled down by sample_ratio to keep
+        very large estates tractable.
+    '''
+
+    def __init__(self, estate, clock, sample_ratio=1.0):
+        self.estate = estate
+        self.clock = clock
+        self.sample_ratio = sample_ratio
+        self.random = random.Random(1)
+
+    def query_resource(self, resource_uri, metric_names, metric_namespace=None, timespan=None, granularity=None, aggregations=None, filter=None):
+        self.clock.charge('metrics.query_resource', resource_uri.split('/')[2])
+        account_name = resource_uri.rstrip('/').split('/')[-1]
+        database_name = filter.split("DatabaseName eq '")[1].split("'")[0]
+        container_name = filter.split("CollectionName eq '")[1].split("'")[0] if 'CollectionName' in filter else None
+        regions = [region.lower().replace(' ', '') for region in self.estate.regions[account_name]]
+        partitions = self.estate.partitions.get((account_name, database_name, container_name), 1)
+        points = max(1, int((timespan[1] - timespan[0]) / granularity * self.sample_ratio))
+        timestamps = [timespan[0] + granularity * i for i in range(points)]
+
+        metrics = []
+        for metric_name in metric_names:
+            if metric_name in ('TotalRequests', 'TotalRequestUnits'):
+                series = [{'operationtype': operation_type, 'region': region, 'statuscode': '200'} for operation_type in OPERATION_TYPES for region in regions]
+            elif metric_name == 'NormalizedRUConsumption':
+                series = [{'region': region, 'partitionkeyrangeid': str(partition), 'physicalpartitionid': str(partition)} for partition in range(partitions) for region in regions]
+            else:
+                series = [{}]
+            timeseries = [
+                types.SimpleNamespace(metadata_values=metadata_values, data=[self.metric_value(timestamp) for timestamp in timestamps])
+                for metadata_values in series
+            ]
+            metrics.append(types.SimpleNamespace(name=metric_name, timeseries=timeseries))
+        return types.SimpleNamespace(metrics=metrics)
+
+    def metric_value(self, timestamp):
+        value = self.random.randint(0, 100)
+        return types.SimpleNamespace(timestamp=timestamp.replace(tzinfo=None), count=value, maximum=value, total=value * 1000)
+
+
+class FakeLogsIngestionClient:
+    '''
+        Stands in for LogsIngestionClient and records rows, bytes, and requests per stream.
+    '''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def upload(self, rule_id, stream_name, logs, **kwargs):
+        self.clock.charge('ingestion.upload')
+        with self.lock:
+            stream = self.streams.setdefault(stream_name, {'rows': 0, 'bytes': 0, 'requests': 0})
+            stream['rows'] += len(logs)
+            stream['bytes'] += len(json.dumps(logs).encode('utf-8'))
+            stream['requests'] += 1
@@ -0,0 +1,362 @@
+'''
+    End-to-end crawl benchmark. Drives TaskInitializer and TaskExecutor.main
+    against a simulated Cosmos DB estate through an in-memory queue and reports
+    makespan, per-task latency percentiles, API calls per type, and bytes
+    ingested. Run from the repository root, e.g.
+
+        python -m benchmarks.run_crawl --preset medium --skew 0.8 --label baseline
+        python -m benchmarks.run_crawl --compare benchmarks/results/a.json benchmarks/results/b.json
+
+    API latency is simulated on a virtual clock rather than slept, and tasks are
+    scheduled on --workers simulated workers, so large estates complete in a
+    fraction of their simulated makespan. Local CPU time of each task is added
+    to its simulated duration.
+'''
+import argparse
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import statistics
+import subprocess
+import time
+
+import azure.functions as func
+
+import TaskExecutor
+import TaskInitializer
+from TaskExecutor import ingestion, manifest, scheduler, store, telemetry, topology_cache
+from .estate import DEFAULT_READ_QUOTA_BURST, DEFAULT_READ_QUOTA_RATE, Estate, FakeCosmosDBManagementClient, FakeLogsIngestionClient, FakeMetricsQueryClient, FakeSubscriptionClient, SimulationClock
+
+# subscriptions, accounts, databases per account, containers per database
+PRESETS = {
+    'small': (2, 10, 2, 5),          # 100 containers
+    'medium': (5, 50, 4, 5),         # 1,000 containers
+    'large': (10, 250, 8, 5),        # 10,000 containers
+    'xlarge': (20, 1000, 10, 10)     # 100,000 containers
+}
+TABLES = ['DatabaseAccountsConfig', 'DatabasesConfig', 'ContainersConfig', 'ContainersMetrics', 'ContainersMetricsSummary', 'WatcherTelemetry']
+SCHEDULER_INTERVAL_SECONDS = 10
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class TimedQueue(scheduler.InMemoryQueue):
+    '''
+        In-memory tasks queue that remembers when each message was enqueued on
+        the simulated clock, used to report dequeue lag.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+        self.enqueued_at = {}
+
+    def send_message(self, content):
+        super().send_message(content)
+        self.enqueued_at[self.messages[-1].id] = self.now
+
+
+class QueueOutput:
+
+    def __init__(self):
+        self.messages = []
+
+    def set(self, messages):
+        self.messages = list(messages)
+
+
+class DeferredScheduler:
+    '''
+        Holds messages a task sends to the shard queues, and the shard lease it
+        releases, until the task finishes on the simulated clock. The harness then
+        hands them to the real scheduler and drains it, as TaskExecutor would at
+        the end of the task.
+    '''
+
+    def __init__(self):
+        self.messages = []
+        self.leases = []
+
+    def enqueue(self, messages):
+        self.messages.extend(messages)
+        return set()
+
+    def release(self, lease):
+        self.leases.append(lease)
+
+    def drain(self, shards=None):
+        pass
+
+
+def subscription_of(message):
+    rid = json.loads(message).get('rid')
+    return rid.split('/')[2] if rid else None
+
+def task_name(message):
+    _input = json.loads(message)
+    metric_type = (_input.get('taskData') or {}).get('metricType')
+    return f"{_input['task']}:{metric_type}" if metric_type else _input['task']
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], text=True, stderr=subprocess.DEVNULL).strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def configure_task_executor(estate, clock, metric_sample_ratio, shards, shard_cap, spool, enable_telemetry, topology):
+    '''
+        Points TaskExecutor at fake clients and configures optional spooling and
+        sharded scheduling on in-memory stand-ins, and the topology cache to use,
+        if any. Returns the fake ingestion
+        client, the tasks queue, and the task scheduler if sharding is enabled.
+    '''
+    for table in TABLES:
+        os.environ[f'AzureMonitorDataCollectionRuleId{table}'] = f'dcr-{table}'
+        os.environ[f'AzureMonitorDataCollectionStreamName{table}'] = f'Custom-{table}_CL'
+    # Benchmark runs must not resume from, or record into, a real run manifest.
+    os.environ.pop('WatcherManifestType', None)
+    manifest.run_manifest = None
+    os.environ.pop('WatcherTopologyCacheType', None)
+    os.environ['WatcherTopologyFullRefreshDays'] = '0'
+    topology_cache.topology_cache = topology
+
+    ingestion_client = FakeLogsIngestionClient(clock)
+    TaskExecutor.mgmt_credential = object()
+    TaskExecutor.monitor_credential = object()
+    TaskExecutor.subscription_client = FakeSubscriptionClient(estate, clock)
+    TaskExecutor.cosmos_clients = {subscription.subscription_id: FakeCosmosDBManagementClient(estate, clock, subscription.subscription_id) for subscription in estate.subscriptions}
+    TaskExecutor.monitor_client = ingestion_client
+    TaskExecutor.metrics_client = FakeMetricsQueryClient(estate, clock, metric_sample_ratio)
+
+    # Age-based flushing would run on the wall clock, so the spool is only flushed by size and at the end of the run.
+    ingestion.log_spool = ingestion.LogSpool(ingestion_client, max_age_seconds=86400) if spool else None
+    os.environ['AzureMonitorSpoolEnabled'] = 'true' if spool else 'false'
+    telemetry.telemetry_spool = ingestion.LogSpool(ingestion_client, max_rows=500, max_age_seconds=86400)
+    os.environ['WatcherTelemetryEnabled'] = 'true' if enable_telemetry else 'false'
+
+    tasks_queue = TimedQueue()
+    task_scheduler = None
+    if shards:
+        queues = {'tasks': tasks_queue}
+        task_scheduler = scheduler.TaskScheduler(lambda name: queues.setdefault(name, scheduler.InMemoryQueue()), shards, shard_cap=shard_cap)
+    scheduler.task_scheduler = DeferredScheduler() if shards else None
+    os.environ['WatcherShardCount'] = str(shards)
+    return ingestion_client, tasks_queue, task_scheduler
+
+def run(estate, clock, workers, metric_sample_ratio=0.1, shards=0, shard_cap=16, spool=False, enable_telemetry=False, topology=None):
+    '''
+        Simulates a full crawl on a discrete-event clock with a fixed number of workers.
+    '''
+    ingestion_client, tasks_queue, task_scheduler = configure_task_executor(estate, clock, metric_sample_ratio, shards, shard_cap, spool, enable_telemetry, topology)
+
+    initial_output = QueueOutput()
+    TaskInitializer.main(None, initial_output)
+    for message in initial_output.messages:
+        tasks_queue.send_message(message)
+
+    events = []
+    sequence = itertools.count()
+    idle_workers = workers
+    running = 0
+    now = 0.0
+    makespan = 0.0
+    subscription_finished = {}
+    durations = {}
+    lags = []
+    failures = {}
+    started = time.perf_counter()
+
+    if task_scheduler is not None:
+        heapq.heappush(events, (SCHEDULER_INTERVAL_SECONDS, next(sequence), 'drain', None))
+
+    while True:
+        while idle_workers and tasks_queue.messages:
+            message = tasks_queue.receive_messages(max_messages=1)[0]
+            tasks_queue.delete_message(message)
+            lags.append(now - tasks_queue.enqueued_at.pop(message.id))
+
+            output = QueueOutput()
+            clock.start_task(now)
+            cpu_started = time.perf_counter()
+            try:
+                TaskExecutor.main(func.QueueMessage(body=message.content.encode('utf-8')), output)
+            except Exception as e:
+                failures[task_name(message.content)] = failures.get(task_name(message.content), 0) + 1
+                logging.warning(f'Task failed: {e}')
+            duration = clock.end_task() + time.perf_counter() - cpu_started
+            durations.setdefault(task_name(message.content), []).append(duration)
+
+            emitted = (output.messages, [])
+            if task_scheduler is not None:
+                emitted = (scheduler.task_scheduler.messages, scheduler.task_scheduler.leases)
+                scheduler.task_scheduler.messages, scheduler.task_scheduler.leases = [], []
+            idle_workers -= 1
+            running += 1
+            heapq.heappush(events, (now + duration, next(sequence), 'finish', (subscription_of(message.content), *emitted)))
+
+        if not events:
+            break
+        now, _, kind, emitted = heapq.heappop(events)
+        tasks_queue.now = now
+        if kind == 'finish':
+            makespan = now
+            subscription_id, messages, leases = emitted
+            if subscription_id:
+                subscription_finished[subscription_id] = now
+            idle_workers += 1
+            running -= 1
+            if task_scheduler is not None:
+                shards = task_scheduler.enqueue(messages)
+                for lease in leases:
+                    task_scheduler.release(lease)
+                    shards.add(lease['shard'])
+                task_scheduler.drain(shards)
+            else:
+                for message in messages:
+                    tasks_queue.send_message(message)
+        elif kind == 'drain':
+            task_scheduler.drain()
+            pending = any(queue.messages for name, queue in task_scheduler.queues.items() if name != 'tasks' and not name.endswith('-leases'))
+            if running or pending or tasks_queue.messages:
+                heapq.heappush(events, (now + SCHEDULER_INTERVAL_SECONDS, next(sequence), 'drain', None))
+
+    if ingestion.log_spool is not None:
+        ingestion.log_spool.flush_all()
+    telemetry.telemetry_spool.flush_all()
+
+    return {
+        'makespan_seconds': round(makespan, 3),
+        'wall_clock_seconds': round(time.perf_counter() - started, 3),
+        'tasks': sum(len(values) for values in durations.values()),
+        'failed_tasks': failures,
+        'dequeue_lag_seconds': {'p50': round(percentile(lags, 50), 3), 'p95': round(percentile(lags, 95), 3), 'max': round(max(lags), 3)},
+        'task_latency_seconds': {
+            name: {
+                'count': len(values),
+                'mean': round(statistics.fmean(values), 4),
+                'p50': round(percentile(values, 50), 4),
+                'p90': round(percentile(values, 90), 4),
+                'p99': round(percentile(values, 99), 4)
+            }
+            for name, values in sorted(durations.items())
+        },
+        'api_calls': dict(sorted(clock.api_calls.items())),
+        'throttles': dict(sorted(clock.throttles.items())),
+        'subscription_throttles': dict(sorted(clock.subscription_throttles.items())),
+        # Time at which the last task of each subscription finished.
+        'subscription_finish_seconds': {subscription_id: round(finished, 3) for subscription_id, finished in sorted(subscription_finished.items())},
+        'ingestion': dict(sorted(ingestion_client.streams.items())),
+        'ingested_bytes': sum(stream['bytes'] for stream in ingestion_client.streams.values()),
+        'ingestion_requests': sum(stream['requests'] for stream in ingestion_client.streams.values()),
+        # Storage calls made on shard and lease queues, excluding those on the tasks queue.
+        'scheduler_queue_calls': sum(queue.calls for name, queue in task_scheduler.queues.items() if name != 'tasks') if task_scheduler is not None else 0
+    }
+
+def compare(paths):
+    '''
+        Prints headline numbers of saved results side by side.
+    '''
+    results = []
+    for path in paths:
+        with open(path) as f:
+            results.append(json.load(f))
+    rows = [
+        ('revision', lambda r: r['revision']),
+        ('label', lambda r: r['parameters']['label']),
+        ('containers', lambda r: r['estate']['containers']),
+        ('makespan_seconds', lambda r: r['results']['makespan_seconds']),
+        ('tasks', lambda r: r['results']['tasks']),
+        ('api_calls', lambda r: sum(r['results']['api_calls'].values())),
+        ('throttles', lambda r: sum(r['results']['throttles'].values())),
+        ('max_sub_throttles', lambda r: max(r['results'].get('subscription_throttles', {}).values(), default=0)),
+        ('median_sub_finish', lambda r: statistics.median(r['results']['subscription_finish_seconds'].values()) if r['results'].get('subscription_finish_seconds') else None),
+        ('ingestion_requests', lambda r: r['results']['ingestion_requests']),
+        ('scheduler_queue_calls', lambda r: r['results'].get('scheduler_queue_calls', 0)),
+        ('ingested_bytes', lambda r: r['results']['ingested_bytes'])
+    ]
+    for name, value in rows:
+        print(f'{name:<20}' + ''.join(f'{str(value(result)):>24}' for result in results))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a full crawl against a simulated Cosmos DB estate.')
+    parser.add_argument('--preset', choices=PRESETS, default='small', help='Estate size, from 100 (small) to 100,000 (xlarge) containers.')
+    parser.add_argument('--subscriptions', type=int)
+    parser.add_argument('--accounts', type=int)
+    parser.add_argument('--databases-per-account', type=int)
+    parser.add_argument('--containers-per-database', type=int)
+    parser.add_argument('--skew', type=float, default=0.0, help='Share of accounts placed in the first subscription.')
+    parser.add_argument('--serverless-ratio', type=float, default=0.15)
+    parser.add_argument('--shared-database-ratio', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=16, help='Number of simulated concurrent TaskExecutor invocations.')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='Multiplier applied to simulated API latency.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Probability that an API call is throttled with 429.')
+    parser.add_argument('--read-quota-burst', type=int, default=DEFAULT_READ_QUOTA_BURST, help='Reads a subscription can burst before being throttled.')
+    parser.add_argument('--read-quota-rate', type=float, default=DEFAULT_READ_QUOTA_RATE, help='Reads per second refilled into a subscription\'s quota, 0 for unlimited.')
+    parser.add_argument('--metric-sample-ratio', type=float, default=0.1, help='Share of metric data points returned per series.')
+    parser.add_argument('--shards', type=int, default=0, help='Enable sharded scheduling with this many shards.')
+    parser.add_argument('--shard-cap', type=int, default=16)
+    parser.add_argument('--spool', action='store_true', help='Enable the ingestion spool.')
+    parser.add_argument('--telemetry', action='store_true', help='Enable watcher telemetry.')
+    parser.add_argument('--topology-cache', action='store_true', help='Enable the topology cache, warmed by an unmeasured crawl.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='default')
+    parser.add_argument('--output', help=f'Result file, defaults to a new file in {RESULTS_DIRECTORY}.')
+    parser.add_argument('--compare', nargs='+', metavar='RESULT', help='Compare saved result files instead of running.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+    subscriptions, accounts, databases_per_account, containers_per_database = PRESETS[args.preset]
+    estate_parameters = {
+        'subscriptions': args.subscriptions or subscriptions,
+        'accounts': args.accounts or accounts,
+        'databases_per_account': args.databases_per_account or databases_per_account,
+        'containers_per_database': args.containers_per_database or containers_per_database,
+        'skew': args.skew,
+        'serverless_ratio': args.serverless_ratio,
+        'shared_database_ratio': args.shared_database_ratio,
+        'seed': args.seed
+    }
+    estate = Estate(**estate_parameters)
+    topology = None
+    if args.topology_cache:
+        # Measure a crawl that follows an earlier one, as nightly crawls do.
+        topology = store.SQLiteStore(':memory:', 'topology')
+        warmup_clock = SimulationClock(seed=args.seed, latency_scale=args.latency_scale, throttle_rate=args.throttle_rate, read_quota_burst=args.read_quota_burst, read_quota_rate=args.read_quota_rate)
+        run(estate, warmup_clock, args.workers, args.metric_sample_ratio, args.shards, args.shard_cap, args.spool, False, topology)
+    clock = SimulationClock(seed=args.seed, latency_scale=args.latency_scale, throttle_rate=args.throttle_rate, read_quota_burst=args.read_quota_burst, read_quota_rate=args.read_quota_rate)
+    results = run(estate, clock, args.workers, args.metric_sample_ratio, args.shards, args.shard_cap, args.spool, args.telemetry, topology)
+
+    revision = git_revision()
+    report = {
+        'revision': revision,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'parameters': vars(args),
+        'estate': dict(estate_parameters, containers=estate.container_count()),
+        'results': results
+    }
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f"{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')}_{revision}_{args.label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{estate.container_count()} containers, {results['tasks']} tasks, makespan {results['makespan_seconds']}s (simulated), {results['wall_clock_seconds']}s wall clock")
+    print(f"API calls: {sum(results['api_calls'].values())}, throttles: {sum(results['throttles'].values())}, ingestion: {results['ingestion_requests']} requests, {results['ingested_bytes']} bytes")
+    finished = results['subscription_finish_seconds'].values()
+    print(f"Subscriptions finished after {min(finished, default=0)}s to {max(finished, default=0)}s, most throttled: {max(results['subscription_throttles'].values(), default=0)} throttles")
+    print(f'Results saved to {output}')
+
+
+if __name__ == '__main__':
+    main()